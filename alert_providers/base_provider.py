@@ -19,18 +19,18 @@ class BaseAlertProvider(ABC):
     def get_response_json(self, url, headers={}):
         """
         Perform an HTTP GET for a `url` with optional `headers`.
-        Caches the response in `cache_file_name` for ALERT_TTL seconds.
+        Caches the response for ALERT_TTL seconds, keyed by the provider, URL and headers.
         Returns the response as JSON
         """
-        return get_json_from_url(url, headers, "cache_severe_alert.json", self.ttl)
+        return get_json_from_url(url, headers, type(self).__name__, self.ttl)
 
     def get_response_xml(self, url, headers={}):
         """
         Perform an HTTP GET for a `url` with optional `headers`.
-        Caches the response in `cache_file_name` for ALERT_TTL seconds.
+        Caches the response for ALERT_TTL seconds, keyed by the provider, URL and headers.
         Returns the response as an XML ElementTree
         """        
-        return get_xml_from_url(url, headers, "cache_severe_alert.xml", self.ttl)
+        return get_xml_from_url(url, headers, type(self).__name__, self.ttl)
 
 
     
\ No newline at end of file
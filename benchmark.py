@@ -0,0 +1,421 @@
+#!/usr/bin/python3
+import argparse
+import datetime
+import importlib
+import json
+import math
+import os
+import re
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+# Everything runs from recorded fixtures, in a throwaway cache, with quiet logs so that logging isn't what's measured
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+benchmark_dir = tempfile.mkdtemp(prefix="epaper-benchmark-")
+os.environ["CACHE_STORE_FILE"] = os.path.join(benchmark_dir, "cache_store.db")
+os.environ["WRITE_DEBUG_OUTPUT"] = "0"
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+
+import provider_registry  # noqa: E402
+from utility import render_svg, get_template_svg_filename  # noqa: E402
+from rasterize import render_image, get_screen_size  # noqa: E402
+from frame_diff import get_dirty_regions  # noqa: E402
+import frame_pack  # noqa: E402
+import native_render  # noqa: E402
+
+screen_calendar_get = importlib.import_module("screen-calendar-get")
+screen_weather_get = importlib.import_module("screen-weather-get")
+
+fixtures_dirname = os.path.join("benchmarks", "fixtures")
+baseline_filename = os.path.join("benchmarks", "baseline.json")
+
+# The SVGs are rasterized as if they were in the throwaway directory, so that the custom SVG they reference
+# is written there rather than into the working tree. The icons are linked in from the project.
+custom_svg_filename = os.path.join(benchmark_dir, "screen-output-custom-temp.svg")
+base_url = os.path.join(benchmark_dir, "screen-output-weather.svg")
+
+# The day the fixtures were recorded. Their dates are moved to today, so that the providers find today's forecast.
+recorded_date = datetime.date(2023, 1, 16)
+
+# eg. 2023-01-16, in JSON and XML, and 20230116 in ICS
+iso_date_pattern = re.compile(r"(?<![\d-])(\d{4})-(\d{2})-(\d{2})(?![\d-])")
+ics_date_pattern = re.compile(r"(?<![\d-])(\d{4})(\d{2})(\d{2})(?=T\d{6}|\s)")
+
+# Stages quicker than this, in seconds, are too noisy to call a regression
+min_regression = 0.0005
+min_memory_regression = 16 * 1024
+
+location = {"location_lat": "51.5077", "location_long": "-0.1277", "units": "metric"}
+
+
+def block_network():
+    """
+    Makes sure that nothing in the benchmark talks to the network
+    """
+
+    def connect(*args, **kwargs):
+        raise RuntimeError("The benchmark must not use the network")
+
+    socket.socket.connect = connect
+    socket.create_connection = connect
+
+
+def shift_dates(text, days):
+    def shift_iso(match):
+        day = datetime.date(*map(int, match.groups())) + datetime.timedelta(days=days)
+        return day.isoformat()
+
+    def shift_ics(match):
+        day = datetime.date(*map(int, match.groups())) + datetime.timedelta(days=days)
+        return day.strftime("%Y%m%d")
+
+    return ics_date_pattern.sub(shift_ics, iso_date_pattern.sub(shift_iso, text))
+
+
+def load_fixture(filename):
+    with open(os.path.join(fixtures_dirname, filename), "r", encoding="utf-8") as fixture_file:
+        text = fixture_file.read()
+    return shift_dates(text, (datetime.date.today() - recorded_date).days)
+
+
+def serve_fixture(provider, filename):
+    """
+    Answers the provider's requests from a fixture. The fixture is still decoded on every call, like a response would be.
+    """
+    text = load_fixture(filename)
+    if filename.endswith(".xml"):
+        provider.get_response_xml = lambda url, headers={}: ET.fromstring(text)
+        provider.get_response_text = lambda url, headers={}: text
+    else:
+        provider.get_response_json = lambda url, headers={}: json.loads(text)
+
+
+def get_fixture_filename(kind, name):
+    for extension in (".json", ".xml"):
+        filename = os.path.join(kind, name + extension)
+        if os.path.isfile(os.path.join(fixtures_dirname, filename)):
+            return filename
+    return None
+
+
+def get_weather_provider(spec):
+    provider = provider_registry.create_provider(spec, **location)
+    serve_fixture(provider, get_fixture_filename("weather", spec.name))
+    if spec.name == "weathergov":
+        points = json.loads(load_fixture("weather/weathergov_points.json"))
+        provider.get_forecast_url = lambda lat, long: points["properties"]["forecast"]
+    return provider
+
+
+def get_alert_provider(spec):
+    provider = provider_registry.create_provider(spec, **location)
+    serve_fixture(provider, get_fixture_filename("alert", spec.name))
+    return provider
+
+
+def get_calendar_parser(spec):
+    """
+    Returns a function that turns the calendar fixture into `CalendarEvent`s, the way the provider does
+    """
+    from_date, to_date = screen_calendar_get.get_calendar_date_range()
+    provider = provider_registry.create_provider(
+        spec, max_event_results=screen_calendar_get.max_event_results, from_date=from_date, to_date=to_date
+    )
+
+    if spec.name in ("google", "outlook"):
+        text = load_fixture(os.path.join("calendar", spec.name + ".json"))
+        return lambda: provider.parse_events(json.loads(text))
+
+    text = load_fixture(os.path.join("calendar", "events.ics"))
+    if spec.name == "caldav":
+        # The whole fixture as one resource, parsed and then expanded over the window
+        return lambda: provider.expand_stored_events(provider.parse_resource(text))
+
+    if spec.name == "ics":
+        # A first sync, with nothing stored yet, then the expansion over the window
+        return lambda: provider.expand_stored_events(provider.get_stored_events(provider.sync_feed(None, text)))
+
+    return None
+
+
+def pack_frame_like_driver(image):
+    """
+    Packs a rendered image into the panel's frame buffer, the same way the Waveshare 7.5 inch V2 driver's getbuffer() does,
+    to compare with frame_pack.py
+    """
+    width, height = get_screen_size()
+    if image.size == (height, width):
+        image = image.rotate(90, expand=True)
+    buffer = bytearray(image.convert("1").tobytes("raw"))
+    # In PIL 0 is black, on the panel 1 is black
+    for index in range(len(buffer)):
+        buffer[index] ^= 0xFF
+    return buffer
+
+
+def pack_frame(image):
+    width, height = get_screen_size()
+    return frame_pack.pack_frame(image, width, height)
+
+
+class MockSpi:
+    """
+    Stands in for spidev. The driver writes a frame in chunks of up to 4096 bytes, toggling the GPIO pins around each one.
+    """
+
+    chunk_size = 4096
+
+    def __init__(self, size):
+        self.sink = bytearray(size)
+        self.written = 0
+
+    def digital_write(self, pin, value):
+        pass
+
+    def writebytes2(self, data):
+        self.sink[self.written:self.written + len(data)] = data
+        self.written += len(data)
+
+    def send_frame(self, frame):
+        self.written = 0
+        frame = memoryview(frame)
+        for start in range(0, len(frame), self.chunk_size):
+            self.digital_write(8, 0)
+            self.writebytes2(frame[start:start + self.chunk_size])
+            self.digital_write(8, 1)
+
+
+def measure(stage, iterations):
+    """
+    Runs `stage` once to warm up, then `iterations` times for the wall times, then once more for the peak Python memory.
+    Memory allocated by C libraries such as cairo isn't traced.
+    """
+    stage()
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        stage()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    stage()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times.sort()
+    return {
+        "median": statistics.median(times),
+        "p95": times[max(0, math.ceil(len(times) * 0.95) - 1)],
+        "peak_memory": peak_memory,
+    }
+
+
+def get_stages():
+    """
+    Returns (name, function) for every stage of the pipeline, from parsing the fixtures to sending the frame
+    """
+    stages = []
+
+    weather_providers = {}
+    for spec in provider_registry.weather_providers:
+        provider = weather_providers[spec.name] = get_weather_provider(spec)
+        stages.append(("parse.weather." + spec.name, provider.get_weather))
+
+    alert_provider = None
+    for spec in provider_registry.alert_providers:
+        alert_provider = get_alert_provider(spec)
+        stages.append(("parse.alert." + spec.name, alert_provider.get_alert))
+
+    calendar_events = None
+    for spec in provider_registry.calendar_providers:
+        parser = get_calendar_parser(spec)
+        stages.append(("parse.calendar." + spec.name, parser))
+        if spec.name == "google":
+            calendar_events = parser()
+
+    # Climacell has a forecast for each day, so the calendar's day headings get the weather too
+    weather_dict = screen_weather_get.get_weather_output(weather_providers["climacell"])
+    stages.append(
+        ("format_calendar", lambda: screen_calendar_get.get_formatted_calendar_events(calendar_events, weather_dict))
+    )
+
+    output_dict = dict(weather_dict)
+    output_dict.update(
+        {
+            "ALERT_MESSAGE_VISIBILITY": "visible",
+            "ALERT_MESSAGE": screen_weather_get.format_alert_description(alert_provider.get_alert()),
+        }
+    )
+    output_dict.update(screen_weather_get.get_time_output())
+    output_dict.update(screen_calendar_get.get_calendar_output(calendar_events, weather_dict))
+
+    template_svg_filename = get_template_svg_filename()
+    stages.append(("substitute", lambda: render_svg(template_svg_filename, output_dict)))
+
+    # The custom SVG and the icons are referenced by the templates, like in compose.py
+    with open(custom_svg_filename, "w") as custom_svg:
+        custom_svg.write("<svg />\n")
+    os.symlink(os.path.abspath("icons"), os.path.join(benchmark_dir, "icons"))
+
+    svg = render_svg(template_svg_filename, output_dict)
+    stages.append(("rasterize", lambda: render_image(svg, base_url)))
+
+    # Each layout that can be drawn natively, whichever layout is configured
+    for layout_filename in native_render.template_layouts:
+        stages.append(
+            (
+                "rasterize.native." + os.path.splitext(layout_filename)[0],
+                lambda layout_filename=layout_filename: native_render.render_native(output_dict, layout_filename),
+            )
+        )
+
+    image = render_image(svg, base_url)
+    stages.append(("pack", lambda: pack_frame(image)))
+    stages.append(("pack.getbuffer", lambda: pack_frame_like_driver(image)))
+    width, height = get_screen_size()
+    stages.append(("pack.2b", lambda: frame_pack.pack_planes(image, width, height)))
+
+    # A minute later, only the time has changed
+    next_output_dict = dict(output_dict, TIME_NOW="23:59", HOUR_NOW="23:59")
+    frame = pack_frame(image)
+    next_frame = pack_frame(render_image(render_svg(template_svg_filename, next_output_dict), base_url))
+    stages.append(("diff", lambda: get_dirty_regions(frame, next_frame, width, height)))
+
+    spi = MockSpi(len(frame))
+    stages.append(("spi", lambda: spi.send_frame(frame)))
+
+    return stages, output_dict
+
+
+def check_parity(output_dict, threshold):
+    """
+    Compares each natively drawn layout with the same layout rendered from its SVG by CairoSVG.
+    Returns the layouts that differ by more than `threshold`.
+    """
+    failures = []
+    print("{:<32} {:>10}".format("layout", "differs"))
+    for layout_filename in native_render.template_layouts:
+        reference = render_image(render_svg(layout_filename, output_dict), base_url)
+        image = native_render.render_native(output_dict, layout_filename)
+        error = native_render.get_parity_error(image, reference)
+        print("{:<32} {:>10.2%}".format(layout_filename, error))
+        if error > threshold:
+            failures.append(layout_filename)
+            image.save(os.path.join(benchmark_dir, layout_filename + ".native.png"))
+            reference.save(os.path.join(benchmark_dir, layout_filename + ".svg.png"))
+            print("  Saved both renders to {}".format(benchmark_dir))
+    return failures
+
+
+def remove_benchmark_dir():
+    shutil.rmtree(benchmark_dir, ignore_errors=True)
+
+
+def load_baseline(filename):
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, "r") as baseline_file:
+        return json.load(baseline_file)
+
+
+def get_regressions(name, result, baseline, threshold):
+    """
+    Returns a description of each way `result` is worse than the `baseline` by more than `threshold`
+    """
+    regressions = []
+    if name not in baseline:
+        return regressions
+
+    previous = baseline[name]
+    if result["median"] > previous["median"] * (1 + threshold) and result["median"] - previous["median"] > min_regression:
+        regressions.append(
+            "{} median {:.2f}ms, was {:.2f}ms".format(name, result["median"] * 1000, previous["median"] * 1000)
+        )
+    if (
+        result["peak_memory"] > previous["peak_memory"] * (1 + threshold)
+        and result["peak_memory"] - previous["peak_memory"] > min_memory_regression
+    ):
+        regressions.append(
+            "{} peak memory {:.0f}KB, was {:.0f}KB".format(
+                name, result["peak_memory"] / 1024, previous["peak_memory"] / 1024
+            )
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times each stage of a refresh, from recorded fixtures, without a network or panel.")
+    parser.add_argument("--iterations", type=int, default=20, help="how many times to run each stage")
+    parser.add_argument("--only", default="", help="only run the stages whose name contains this")
+    parser.add_argument("--baseline", default=baseline_filename, help="the results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="how much slower, as a fraction, is a regression")
+    parser.add_argument("--save-baseline", action="store_true", help="save these results as the baseline")
+    parser.add_argument("--parity", action="store_true", help="compare the native renders with CairoSVG instead")
+    parser.add_argument("--parity-threshold", type=float, default=0.02, help="how much of the ink may differ")
+    args = parser.parse_args()
+
+    block_network()
+    failures = []
+    try:
+        stages, output_dict = get_stages()
+        if args.parity:
+            failures = check_parity(output_dict, args.parity_threshold)
+            return 1 if failures else 0
+        return run_stages(stages, args)
+    finally:
+        # The renders that failed the parity check are kept, to look at
+        if not failures:
+            remove_benchmark_dir()
+
+
+def run_stages(stages, args):
+    """
+    Times each stage, and compares the results with the baseline, or saves them as the baseline.
+    Returns the exit status.
+    """
+    baseline = load_baseline(args.baseline)
+    if not baseline and not args.save_baseline:
+        print("There's no baseline at {} to compare with, record one first with --save-baseline".format(args.baseline))
+
+    results = {}
+    regressions = []
+    print("{:<32} {:>10} {:>10} {:>10} {:>10}".format("stage", "median", "p95", "peak", "baseline"))
+    for name, stage in stages:
+        if args.only not in name:
+            continue
+        result = results[name] = measure(stage, args.iterations)
+        previous = baseline.get(name)
+        print(
+            "{:<32} {:>8.2f}ms {:>8.2f}ms {:>8.0f}KB {:>10}".format(
+                name,
+                result["median"] * 1000,
+                result["p95"] * 1000,
+                result["peak_memory"] / 1024,
+                "{:+.0%}".format(result["median"] / previous["median"] - 1) if previous else "-",
+            )
+        )
+        regressions += get_regressions(name, result, baseline, args.threshold)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        print("Saved the baseline to {}".format(args.baseline))
+        return 0
+
+    if regressions:
+        print("Regressions over {:.0%}:".format(args.threshold))
+        for regression in regressions:
+            print("  " + regression)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Any, NamedTuple
+
+cache_store_filename = os.getenv("CACHE_STORE_FILE", "cache_store.db")
+
+# Once the cache grows past this many bytes, the least recently used entries are removed
+cache_store_max_size = int(os.getenv("CACHE_STORE_MAX_SIZE", 50 * 1024 * 1024))
+
+
+class CacheEntry(NamedTuple):
+    value: Any
+    stored_at: float
+    ttl: float
+    etag: str
+    last_modified: str
+
+    def is_stale(self):
+        return time.time() - self.stored_at > self.ttl
+
+    def get_age(self):
+        return time.time() - self.stored_at
+
+
+def make_cache_key(*parts):
+    """
+    Builds a key from everything that identifies a request,
+    eg. the provider name, URL, headers and location
+    """
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class CacheStore:
+    """
+    A cache of values by key, kept in a SQLite database.
+    Each entry has its own TTL, and the total size is bounded by evicting the least recently used entries.
+    Every write is a transaction, so a crash or power cut never leaves a half written entry.
+    """
+
+    def __init__(self, filename, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value BLOB, size INTEGER, stored_at REAL, ttl REAL, "
+                "etag TEXT, last_modified TEXT, accessed_at REAL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)"
+            )
+
+    def get(self, key):
+        """
+        Returns the `CacheEntry` for `key`, stale or not, or None if there isn't one
+        """
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT value, stored_at, ttl, etag, last_modified FROM cache WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                logging.debug("CacheStore.get({}) - Not found".format(key))
+                return None
+            self.connection.execute(
+                "UPDATE cache SET accessed_at = ? WHERE key = ?", (time.time(), key)
+            )
+
+        value, stored_at, ttl, etag, last_modified = row
+        entry = CacheEntry(pickle.loads(value), stored_at, ttl, etag, last_modified)
+        logging.debug("CacheStore.get({}) - Age {:.0f}s".format(key, entry.get_age()))
+        return entry
+
+    def set(self, key, value, ttl, etag=None, last_modified=None):
+        data = pickle.dumps(value)
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO cache "
+                "(key, value, size, stored_at, ttl, etag, last_modified, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, data, len(data), now, ttl, etag, last_modified, now),
+            )
+            self.evict()
+        logging.debug("CacheStore.set({}) - {} bytes".format(key, len(data)))
+
+    def touch(self, key, ttl):
+        """
+        Marks an entry as freshly stored, without changing its value
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE cache SET stored_at = ?, ttl = ?, accessed_at = ? WHERE key = ?",
+                (now, ttl, now, key),
+            )
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in `max_size`.
+        Call this inside a transaction.
+        """
+        total_size = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache"
+        ).fetchone()[0]
+        if total_size <= self.max_size:
+            return
+
+        rows = self.connection.execute(
+            "SELECT key, size FROM cache ORDER BY accessed_at"
+        ).fetchall()
+        for key, size in rows:
+            if total_size <= self.max_size:
+                break
+            logging.debug("CacheStore.evict({})".format(key))
+            self.connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+            total_size -= size
+
+
+cache_store = None
+cache_store_lock = threading.Lock()
+
+
+def get_cache_store():
+    """
+    Returns the shared `CacheStore`, opening it on first use
+    """
+    global cache_store
+    with cache_store_lock:
+        if cache_store is None:
+            cache_store = CacheStore(cache_store_filename, cache_store_max_size)
+    return cache_store
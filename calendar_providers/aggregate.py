@@ -0,0 +1,86 @@
+import heapq
+import itertools
+import logging
+import threading
+import provider_registry
+from spans import span
+from calendar_providers.base_provider import BaseCalendarProvider, get_event_sort_key
+
+
+def unique_events(events):
+    """
+    Yields the events, skipping any with the same UID and start, or the same summary and start, as one before it.
+    The same meeting is often in more than one calendar, eg. a work calendar and a shared team one.
+    """
+    seen = set()
+    for event in events:
+        start = get_event_sort_key(event)
+        keys = {("summary", event.summary.strip(), start)}
+        if event.uid:
+            keys.add(("uid", event.uid, start))
+        if keys & seen:
+            continue
+        seen |= keys
+        yield event
+
+
+class CalendarAggregate(BaseCalendarProvider):
+    """
+    Shows the events of several calendars together, eg. CALENDAR_PROVIDERS=google,ics,ics:2,caldav.
+    The calendars are fetched at the same time, and their events, which each provider returns in start order,
+    are merged into one list in start order.
+    """
+
+    def __init__(self, specs, max_event_results, from_date, to_date):
+        self.specs = specs
+        self.max_event_results = max_event_results
+        self.from_date = from_date
+        self.to_date = to_date
+        self.providers = [
+            provider_registry.create_provider(
+                spec, max_event_results=max_event_results, from_date=from_date, to_date=to_date
+            )
+            for spec in specs
+        ]
+
+    def fetch_streams(self):
+        """
+        Starts each calendar's stream of events on a thread of its own, and returns the streams.
+        Reading a stream's first event is what fetches the calendar, so they're all fetched at the same time;
+        the rest of each stream is only expanded as the merge reads it.
+        A calendar that fails is left out, unless they all fail.
+        """
+        streams = [None] * len(self.providers)
+        errors = [None] * len(self.providers)
+
+        def run(index, spec, provider):
+            provider.from_date = self.from_date
+            provider.to_date = self.to_date
+            try:
+                with span("provider.calendar.source", provider=spec.name):
+                    stream = provider.iter_calendar_events()
+                    first = next(stream, None)
+                streams[index] = itertools.chain([first], stream) if first is not None else iter(())
+            except Exception as error:
+                logging.error("Unable to get the events from {}: {}".format(spec.label, error))
+                errors[index] = error
+
+        threads = [
+            threading.Thread(target=run, args=(index, spec, provider), daemon=True)
+            for index, (spec, provider) in enumerate(zip(self.specs, self.providers))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        fetched = [stream for stream in streams if stream is not None]
+        if not fetched and errors:
+            raise errors[0]
+        return fetched
+
+    def iter_calendar_events(self):
+        """
+        Yields the calendars' events merged in start order, without duplicates
+        """
+        yield from unique_events(heapq.merge(*self.fetch_streams(), key=get_event_sort_key))
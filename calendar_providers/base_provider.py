@@ -1,23 +1,110 @@
 
-from abc import ABC, abstractmethod
+from abc import ABC
+import datetime
+import itertools
+import logging
+import os
 import typing
 from typing import NamedTuple
+from dateutil import tz
+from cache_store import get_cache_store
+from utility import cache_max_staleness
+
+# How long, in seconds, a calendar is used from the cache before it's synced again
+calendar_ttl = float(os.getenv("CALENDAR_TTL", 1 * 60 * 60))
+
 
 class CalendarEvent(NamedTuple):
     summary: str
     start: any
     end: any
     all_day_event: bool
+    # The event's UID where the provider has one, so that it can be recognised in more than one calendar
+    uid: str = None
+
+
+def get_event_sort_key(event: CalendarEvent) -> datetime.datetime:
+    """
+    Returns the start of an event as a naive datetime on the local clock, so that all day events (dates),
+    floating times and aware datetimes from different providers can be compared
+    """
+    start = event.start
+    if not isinstance(start, datetime.datetime):
+        return datetime.datetime.combine(start, datetime.time.min)
+    if start.tzinfo is None:
+        return start
+    return start.astimezone(tz.tzlocal()).replace(tzinfo=None)
 
 
 class BaseCalendarProvider(ABC):
 
-    @abstractmethod
+    def iter_calendar_events(self) -> typing.Iterator[CalendarEvent]:
+        """
+        Implement this method, or get_calendar_events().
+        Yield the `CalendarEvent`s between the from and to dates in start order, expanding them as they're asked for,
+        so that the caller can stop once it has enough.
+        """
+        if type(self).get_calendar_events is BaseCalendarProvider.get_calendar_events:
+            raise NotImplementedError("Implement iter_calendar_events() or get_calendar_events()")
+        yield from sorted(self.get_calendar_events(), key=get_event_sort_key)
+
     def get_calendar_events(self) -> list[CalendarEvent]:
         """
-        Implement this method.
-        Return a list of `CalendarEvent` which contains summary, start date, end date, and all day event
+        Return a list of `CalendarEvent` which contains summary, start date, end date, and all day event.
+        By default, the first max_event_results events from iter_calendar_events().
+        """
+        return list(itertools.islice(self.iter_calendar_events(), getattr(self, "max_event_results", None)))
+
+    def get_synced_state(self, cache_key, sync, is_current=None, bypass_cache=False):
+        """
+        Returns what the provider keeps of its calendar, eg. its events and a sync token, from the cache store.
+        Once it's older than CALENDAR_TTL, or `is_current(state)` is false, `sync(state)` brings it up to date,
+        or builds it when `state` is None. If the sync fails, the last state is used for up to CACHE_MAX_STALENESS.
+        When `sync` returns the state it was given, it's unchanged and only marked as fresh.
+        """
+        cache_entry = None if bypass_cache else get_cache_store().get(cache_key)
+        if cache_entry and not cache_entry.is_stale() and (is_current is None or is_current(cache_entry.value)):
+            logging.info("Found in cache")
+            return cache_entry.value
+
+        logging.debug("Cache is stale, syncing {}".format(type(self).__name__))
+        try:
+            state = sync(cache_entry.value if cache_entry else None)
+        except Exception as error:
+            logging.error(error)
+            if cache_entry and cache_entry.get_age() <= cache_max_staleness:
+                logging.warning(
+                    "Using the {} events from {:.0f} seconds ago.".format(type(self).__name__, cache_entry.get_age())
+                )
+                return cache_entry.value
+            raise
+
+        if bypass_cache:
+            return state
+        if cache_entry and state is cache_entry.value:
+            get_cache_store().touch(cache_key, calendar_ttl)
+        else:
+            get_cache_store().set(cache_key, state, calendar_ttl)
+        return state
+
+    def get_from_date(self):
+        """
+        Returns the from date as an aware datetime. get_calendar_date_range() gives it in naive UTC.
+        """
+        if self.from_date.tzinfo is None:
+            return self.from_date.replace(tzinfo=tz.tzutc())
+        return self.from_date
+
+    def iter_stored_events(self, stored_events):
+        """
+        Yields `CalendarEvent`s for ical_store's `StoredEvent`s between the from and to dates, earliest first,
+        expanding recurrences locally as they're read
         """
-        pass
+        # Only the providers that keep StoredEvents load icalendar
+        from ical_store import iter_events
 
+        for instance in iter_events(stored_events, self.get_from_date(), self.to_date):
+            yield CalendarEvent(instance.summary, instance.start, instance.end, instance.all_day, instance.uid)
 
+    def expand_stored_events(self, stored_events) -> list[CalendarEvent]:
+        return list(itertools.islice(self.iter_stored_events(stored_events), self.max_event_results))
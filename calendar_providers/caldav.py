@@ -1,14 +1,22 @@
-
-import pickle
 import caldav
-from utility import is_stale
-import os
+from caldav.elements import dav
+from caldav.lib import error as caldav_error
+from cache_store import make_cache_key
 import logging
-import datetime
-from .base_provider import BaseCalendarProvider, CalendarEvent
+from typing import NamedTuple
+from urllib.parse import unquote
+from ical_store import sync_events
+from .base_provider import BaseCalendarProvider
+
 
+class CalDavState(NamedTuple):
+    """
+    What's known about the calendar collection: its sync-token, and href -> (etag, [`StoredEvent`]) for each resource.
+    The sync-token is None when the server doesn't support sync-collection.
+    """
 
-ttl = float(os.getenv("CALENDAR_TTL", 1 * 60 * 60))
+    sync_token: str
+    resources: dict
 
 
 class CalDavCalendar(BaseCalendarProvider):
@@ -21,53 +29,109 @@ class CalDavCalendar(BaseCalendarProvider):
         self.password = password
         self.from_date = from_date
         self.to_date = to_date
-
-    def get_calendar_events(self):
-
-        caldav_calendar_pickle = 'cache_caldav.pickle'
-        calendar_events: list[CalendarEvent] = []
-
-        if is_stale(os.getcwd() + "/" + caldav_calendar_pickle, ttl):
-            logging.debug("Pickle is stale, fetching Caldav Calendar")
-
-            with caldav.DAVClient(url=self.calendar_url, username=self.username, password=self.password) as client:
-                my_principal = client.principal()
-
-                calendar = my_principal.calendar(cal_id=self.calendar_id)
-                event_results = calendar.date_search(start=self.from_date, end=self.to_date, expand=True)
-                events_data = []
-
-                for result in event_results:
-                    for component in result.icalendar_instance.subcomponents:
-                        events_data.append(component)
-
-            # Sort by start date. Since some are dates, and some are datetimes, a simple string sort works
-            events_data.sort(key=lambda x: str(x['DTSTART'].dt))
-
-            for event in events_data[0:self.max_event_results]:
-
-                # If a dtend isn't included, calculate it from the duration
-                if 'DTEND' in event:
-                    event_end = event['DTEND'].dt
-                if 'DURATION' in event:
-                    event_end = event['DTSTART'].dt + event['DURATION'].dt
-
-                all_day_event = False
-                # CalDav Calendar marks the 'end' of all-day-events as
-                # the day _after_ the last day. eg, Today's all day event ends tomorrow!
-                # So subtract a day, if the event is an all day event
-                if type(event_end) == datetime.date:
-                    event_end = event_end - datetime.timedelta(days=1)
-                    all_day_event = True
-
-                calendar_events.append(CalendarEvent(str(event['SUMMARY']), event['DTSTART'].dt, event_end, all_day_event))
-
-            with open(caldav_calendar_pickle, 'wb') as cal:
-                pickle.dump(calendar_events, cal)
-
-            return calendar_events
-        else:
-            logging.info("Found in cache")
-            with open(caldav_calendar_pickle, 'rb') as cal:
-                calendar_events = pickle.load(cal)
-                return calendar_events
+        # Kept between syncs, so the principal and calendar are only looked up once
+        self.calendar = None
+
+    def parse_resource(self, data):
+        """
+        Returns the `StoredEvent`s in the iCalendar data of one resource
+        """
+        return [event for _, _, event in sync_events({}, data).values()]
+
+    def get_calendar(self):
+        if self.calendar is None:
+            client = caldav.DAVClient(url=self.calendar_url, username=self.username, password=self.password)
+            self.calendar = client.principal().calendar(cal_id=self.calendar_id)
+        return self.calendar
+
+    def get_href(self, resource):
+        return unquote(resource.url.path)
+
+    def load_resources(self, calendar, resources, hrefs):
+        """
+        Fetches the resources at `hrefs` in one calendar-multiget, and returns href -> iCalendar data.
+        Resources that no longer exist aren't in the result.
+        """
+        changed = [resource for resource in resources if self.get_href(resource) in hrefs]
+        if not changed:
+            return {}
+        return {self.get_href(event): event.data for event in calendar.calendar_multiget([r.url for r in changed])}
+
+    def sync_collection(self, calendar, state):
+        """
+        Brings the state up to date with a sync-collection report (RFC 6578).
+        With a sync-token, the server only lists the resources that changed or were deleted since;
+        only the changed ones are downloaded and parsed.
+        """
+        sync_token = state.sync_token if state else None
+        try:
+            changes = calendar.objects_by_sync_token(sync_token, load_objects=False)
+        except caldav_error.ReportError:
+            if sync_token is None:
+                raise
+            logging.info("The sync-token has expired, syncing the whole calendar")
+            sync_token = None
+            changes = calendar.objects_by_sync_token(None, load_objects=False)
+
+        # Without a sync-token every resource is listed, and anything that isn't has been deleted
+        resources = dict(state.resources) if state and sync_token else {}
+        previous = state.resources if state else {}
+
+        listed = {}
+        for resource in changes:
+            listed[self.get_href(resource)] = resource.props.get(dav.GetEtag.tag)
+
+        changed = {
+            href for href, etag in listed.items()
+            if not etag or href not in previous or previous[href][0] != etag
+        }
+        for href, etag in listed.items():
+            if href not in changed:
+                resources[href] = previous[href]
+
+        data = self.load_resources(calendar, changes, changed)
+        for href in changed:
+            if href in data:
+                resources[href] = (listed[href], self.parse_resource(data[href]))
+            else:
+                # Listed without an ETag and not there to fetch, so it was deleted
+                resources.pop(href, None)
+
+        logging.info("CalDAV sync - {} resources, {} changed, {} removed".format(
+            len(resources), len(data), len(previous.keys() - resources.keys())))
+        return CalDavState(changes.sync_token, resources)
+
+    def search_collection(self, calendar):
+        """
+        For servers without sync-collection: fetches the events in the window, unexpanded, to expand locally
+        """
+        results = calendar.date_search(start=self.from_date, end=self.to_date, expand=False)
+        resources = {self.get_href(result): (None, self.parse_resource(result.data)) for result in results}
+        return CalDavState(None, resources)
+
+    def fetch_state(self, state):
+        calendar = self.get_calendar()
+        if state is None or state.sync_token is not None:
+            try:
+                return self.sync_collection(calendar, state)
+            except caldav_error.ReportError as error:
+                logging.info("The server doesn't support sync-collection, searching instead - {}".format(error))
+        return self.search_collection(calendar)
+
+    def sync_state(self, state):
+        try:
+            return self.fetch_state(state)
+        except Exception:
+            # The client may be what failed, so it's looked up again next time
+            self.calendar = None
+            raise
+
+    def get_state(self):
+        cache_key = make_cache_key("calendar", "CalDavCalendar", "sync", self.calendar_url, self.calendar_id)
+        return self.get_synced_state(cache_key, self.sync_state)
+
+    def get_stored_events(self, state):
+        return [event for _, resource_events in state.resources.values() for event in resource_events]
+
+    def iter_calendar_events(self):
+        yield from self.iter_stored_events(self.get_stored_events(self.get_state()))
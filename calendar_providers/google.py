@@ -1,25 +1,37 @@
 import datetime
 from calendar_providers.base_provider import BaseCalendarProvider, CalendarEvent
-from utility import is_stale
+from cache_store import make_cache_key
 import os
 import logging
 import pickle
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-
-ttl = float(os.getenv("CALENDAR_TTL", 1 * 60 * 60))
+from typing import NamedTuple
+from dateutil import parser, tz
+from ical_store import StoredEvent, parse_recurrence
 google_calendar_timezone = os.getenv("GOOGLE_CALENDAR_TIME_ZONE_NAME", None)
 
 
+class GoogleSyncState(NamedTuple):
+    """
+    The calendar's events by id, and the token to list the changes since they were synced
+    """
+
+    sync_token: str
+    events: dict
+
+
 class GoogleCalendar(BaseCalendarProvider):
     def __init__(self, google_calendar_id, max_event_results, from_date, to_date):
         self.max_event_results = max_event_results
         self.from_date = from_date
         self.to_date = to_date
         self.google_calendar_id = google_calendar_id
+        # Built on the first sync, and kept for the daemon's later ones
+        self.service = None
 
     def get_google_credentials(self):
+        # The Google libraries are only imported when the API is called, so a cache hit doesn't load them
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from google.auth.transport.requests import Request
 
         google_token_pickle = 'token.pickle'
         google_credentials_json = 'credentials.json'
@@ -47,53 +59,119 @@ class GoogleCalendar(BaseCalendarProvider):
 
         return credentials
 
-    def get_calendar_events(self) -> list[CalendarEvent]:
-        calendar_events = []
-        google_calendar_pickle = 'cache_calendar.pickle'
-
-        service = build('calendar', 'v3', credentials=self.get_google_credentials(), cache_discovery=False)
-
-        events_result = None
-
-        if is_stale(os.getcwd() + "/" + google_calendar_pickle, ttl):
-            logging.debug("Pickle is stale, calling the Calendar API")
-
-            # Call the Calendar API
-            events_result = service.events().list(
-                calendarId=self.google_calendar_id,
-                timeMin=self.from_date.isoformat() + 'Z',
-                timeZone=google_calendar_timezone,
-                maxResults=self.max_event_results,
-                singleEvents=True,
-                orderBy='startTime').execute()
-
-            for event in events_result.get('items', []):
-                if event['start'].get('date'):
-                    is_all_day = True
-                    start_date = datetime.datetime.strptime(event['start'].get('date'), "%Y-%m-%d")
-                    end_date = datetime.datetime.strptime(event['end'].get('date'), "%Y-%m-%d")
-                    # Google Calendar marks the 'end' of all-day-events as
-                    # the day _after_ the last day. eg, Today's all day event ends tomorrow!
-                    # So subtract a day
-                    end_date = end_date - datetime.timedelta(days=1)
-                else:
-                    is_all_day = False
-                    start_date = datetime.datetime.strptime(event['start'].get('dateTime'), "%Y-%m-%dT%H:%M:%S%z")
-                    end_date = datetime.datetime.strptime(event['end'].get('dateTime'), "%Y-%m-%dT%H:%M:%S%z")
-
-                summary = event['summary']
-
-                calendar_events.append(CalendarEvent(summary, start_date, end_date, is_all_day))
-
-            with open(google_calendar_pickle, 'wb') as cal:
-                pickle.dump(calendar_events, cal)
-
-        else:
-            logging.info("Found in cache")
-            with open(google_calendar_pickle, 'rb') as cal:
-                calendar_events = pickle.load(cal)
-
-        if len(calendar_events) == 0:
-            logging.info("No upcoming events found.")
-
-        return calendar_events
+    def get_service(self):
+        if self.service is None:
+            from googleapiclient.discovery import build
+
+            self.service = build('calendar', 'v3', credentials=self.get_google_credentials(), cache_discovery=False)
+        return self.service
+
+    def get_event_time(self, value):
+        """
+        Returns the start or end of an event: a date for all day events,
+        otherwise a datetime in the event's own time zone, so its recurrences follow that zone's clock
+        """
+        if value.get('date'):
+            return datetime.date.fromisoformat(value['date'])
+        event_time = parser.isoparse(value['dateTime'])
+        event_tz = tz.gettz(value['timeZone']) if value.get('timeZone') else None
+        return event_time.astimezone(event_tz) if event_tz else event_time
+
+    def to_stored_event(self, event) -> StoredEvent:
+        """
+        Turns an event resource into a `StoredEvent`.
+        Recurring events stay as one event with their rule; changed and cancelled instances are their own events,
+        sharing the series' iCalUID. The UID is the iCalUID, so the same event can be recognised in an ICS or CalDAV
+        calendar too; the Google id is only the key in the store. A cancelled instance may only have its
+        recurringEventId, which get_stored_events() turns into the series' UID.
+        """
+        rrule_text, rdates, exdates = parse_recurrence(event['recurrence']) if event.get('recurrence') else (None, [], [])
+        start = self.get_event_time(event['start']) if 'start' in event else None
+        end = self.get_event_time(event['end']) if 'end' in event else start
+        original_start = event.get('originalStartTime')
+        return StoredEvent(
+            uid=event.get('iCalUID') or event.get('recurringEventId', event['id']),
+            sequence=event.get('sequence', 0),
+            recurrence_id=self.get_event_time(original_start) if original_start else None,
+            summary=event.get('summary', ''),
+            start=start,
+            end=end,
+            rrule=rrule_text,
+            rdates=rdates,
+            exdates=exdates,
+            cancelled=event.get('status') == 'cancelled',
+        )
+
+    def merge_events(self, events, items):
+        """
+        Merges a page of event resources into the store of events by id, and returns it.
+        A cancelled event that isn't an instance of a series has been deleted.
+        """
+        for item in items:
+            if item.get('status') == 'cancelled' and not item.get('recurringEventId'):
+                events.pop(item['id'], None)
+            else:
+                events[item['id']] = self.to_stored_event(item)
+        return events
+
+    def list_events(self, state):
+        """
+        Lists the changes since the state's sync token, page by page, or every event if there's no token.
+        Returns the new `GoogleSyncState`.
+        """
+        from googleapiclient.errors import HttpError
+
+        service = self.get_service()
+        sync_token = state.sync_token if state else None
+        events = dict(state.events) if state and sync_token else {}
+
+        arguments = {
+            'calendarId': self.google_calendar_id,
+            'timeZone': google_calendar_timezone,
+            'maxResults': 2500,
+        }
+        # The first sync can't be limited with timeMin, or there's no sync token to carry on from
+        if sync_token:
+            arguments['syncToken'] = sync_token
+
+        changed = 0
+        page_token = None
+        while True:
+            try:
+                events_result = service.events().list(pageToken=page_token, **arguments).execute()
+            except HttpError as error:
+                if sync_token and error.resp.status == 410:
+                    logging.info("The sync token has expired, listing every event")
+                    return self.list_events(None)
+                raise
+            events = self.merge_events(events, events_result.get('items', []))
+            changed += len(events_result.get('items', []))
+            page_token = events_result.get('nextPageToken')
+            if not page_token:
+                break
+
+        logging.info("Google sync - {} events, {} changed".format(len(events), changed))
+        return GoogleSyncState(events_result.get('nextSyncToken'), events)
+
+    def get_state(self):
+        cache_key = make_cache_key(
+            "calendar", "GoogleCalendar", "sync", self.google_calendar_id, google_calendar_timezone)
+        return self.get_synced_state(cache_key, self.list_events)
+
+    def get_stored_events(self, state):
+        # Cancelled instances have no start, but still hide their occurrence of the series
+        events = [event for event in state.events.values() if event.start is not None or event.cancelled]
+        # An instance without an iCalUID has its series' Google id instead, see to_stored_event()
+        return [
+            event._replace(uid=state.events[event.uid].uid) if event.uid in state.events else event for event in events
+        ]
+
+    def parse_events(self, events_result) -> list[CalendarEvent]:
+        """
+        Turns an events.list response into `CalendarEvent`s, between the from and to dates, earliest first
+        """
+        state = GoogleSyncState(None, self.merge_events({}, events_result.get('items', [])))
+        return self.expand_stored_events(self.get_stored_events(state))
+
+    def iter_calendar_events(self):
+        yield from self.iter_stored_events(self.get_stored_events(self.get_state()))
@@ -1,14 +1,21 @@
-
-import datetime
-from calendar_providers.base_provider import BaseCalendarProvider, CalendarEvent
-from utility import is_stale
-import os
+import hashlib
+from calendar_providers.base_provider import BaseCalendarProvider
+from cache_store import make_cache_key
 import logging
-import pickle
-import icalevnt.icalevents
-from dateutil import tz
+from typing import NamedTuple
+from ical_store import sync_events
+from utility import http_session, http_timeout, get_conditional_headers
+
+
+class IcsFeed(NamedTuple):
+    """
+    The events of a feed, the hash of the body they were synced from, and its ETag and Last-Modified
+    """
 
-ttl = float(os.getenv("CALENDAR_TTL", 1 * 60 * 60))
+    body_hash: str
+    events: dict
+    etag: str = None
+    last_modified: str = None
 
 
 class ICSCalendar(BaseCalendarProvider):
@@ -19,37 +26,41 @@ class ICSCalendar(BaseCalendarProvider):
         self.from_date = from_date
         self.to_date = to_date
 
-    def get_calendar_events(self) -> list[CalendarEvent]:
-        calendar_events = []
-        ics_calendar_pickle = 'cache_ics.pickle'
-        if is_stale(os.getcwd() + "/" + ics_calendar_pickle, ttl):
-            logging.debug("Pickle is stale, fetching ICS Calendar")
-
-            ics_events = icalevnt.icalevents.events(self.ics_calendar_url, start=self.from_date, end=self.to_date)
-            ics_events.sort(key=lambda x: x.start.replace(tzinfo=None))
-
-            logging.debug(ics_events)
+    def sync_feed(self, feed, text, etag=None, last_modified=None):
+        """
+        Returns the feed with its events synced from a downloaded body. An unchanged body isn't parsed at all.
+        """
+        body_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if feed and feed.body_hash == body_hash:
+            logging.info("ICS feed is unchanged")
+            return feed._replace(etag=etag, last_modified=last_modified)
+        return IcsFeed(body_hash, sync_events(feed.events if feed else {}, text), etag, last_modified)
 
-            for ics_event in ics_events[0:self.max_event_results]:
-                event_end = ics_event.end
+    def fetch_feed(self, feed):
+        """
+        Downloads the feed if it changed, using the ETag and Last-Modified from the last download
+        """
+        response = http_session.get(
+            self.ics_calendar_url,
+            headers=get_conditional_headers(feed, {}),
+            timeout=http_timeout,
+        )
 
-                # CalDav Calendar marks the 'end' of all-day-events as
-                # the day _after_ the last day. eg, Today's all day event ends tomorrow!
-                # So subtract a day, if the event is an all day event
-                if ics_event.all_day:
-                    event_end = event_end - datetime.timedelta(days=1)
+        if response.status_code == 304 and feed:
+            logging.info("ICS feed not modified")
+            return feed
 
-                # convert to local timezone
-                event_end = ics_event.end.replace(tzinfo=tz.tzutc()).astimezone(tz.tzlocal())
-                event_start = ics_event.start.replace(tzinfo=tz.tzutc()).astimezone(tz.tzlocal())
+        response.raise_for_status()
+        return self.sync_feed(
+            feed, response.text, response.headers.get("ETag"), response.headers.get("Last-Modified")
+        )
 
-                calendar_events.append(CalendarEvent(ics_event.summary, event_start, event_end, ics_event.all_day))
+    def get_feed(self):
+        cache_key = make_cache_key("calendar", "ICSCalendar", "feed", self.ics_calendar_url)
+        return self.get_synced_state(cache_key, self.fetch_feed)
 
-            with open(ics_calendar_pickle, 'wb') as cal:
-                pickle.dump(calendar_events, cal)
-        else:
-            logging.info("Found in cache")
-            with open(ics_calendar_pickle, 'rb') as cal:
-                calendar_events = pickle.load(cal)
+    def get_stored_events(self, feed):
+        return [event for _, _, event in feed.events.values()]
 
-        return calendar_events
+    def iter_calendar_events(self):
+        yield from self.iter_stored_events(self.get_stored_events(self.get_feed()))
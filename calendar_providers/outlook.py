@@ -1,17 +1,37 @@
-
 import datetime
+import itertools
 from calendar_providers.base_provider import BaseCalendarProvider, CalendarEvent
-from utility import is_stale
+from utility import http_session, http_timeout
+from cache_store import make_cache_key
 import os
 import logging
-import pickle
-import msal
 import requests
 import sys
 import json
+import threading
+import time
+from typing import NamedTuple
 from dateutil import tz
 
-ttl = float(os.getenv("CALENDAR_TTL", 1 * 60 * 60))
+# The delta query covers this many days past the ones shown, so that it only has to start over once a month
+outlook_delta_extra_days = 30
+
+# Access tokens are refreshed in the background once they have less than this many seconds left
+outlook_token_refresh_margin = 10 * 60
+
+outlook_client_id = "3b49f0d7-201a-4b5d-b2b4-8f4c3e6c8a30"
+outlook_scopes = ["https://graph.microsoft.com/Calendars.Read"]
+
+
+class OutlookSyncState(NamedTuple):
+    """
+    The events in the delta query's window as `CalendarEvent`s by id, and the deltaLink to get the changes since
+    """
+
+    delta_link: str
+    window_start: datetime.datetime
+    window_end: datetime.datetime
+    events: dict
 
 
 class OutlookCalendar(BaseCalendarProvider):
@@ -21,28 +41,44 @@ class OutlookCalendar(BaseCalendarProvider):
         self.from_date = from_date
         self.to_date = to_date
         self.outlook_calendar_id = outlook_calendar_id
+        # The MSAL app and the last token are kept in memory, so the daemon only goes back to MSAL to refresh it
+        self.app = None
+        self.token_cache = None
+        self.access_token = None
+        self.token_expires_at = 0
+        self.token_lock = threading.Lock()
+        self.refreshing_token = False
 
-    def get_access_token(self):
-        mscache = msal.SerializableTokenCache()
-        if os.path.exists("outlooktoken.bin"):
-            mscache.deserialize(open("outlooktoken.bin", "r").read())
+    def get_app(self):
+        if self.app is None:
+            import msal
+
+            self.token_cache = msal.SerializableTokenCache()
+            if os.path.exists("outlooktoken.bin"):
+                self.token_cache.deserialize(open("outlooktoken.bin", "r").read())
 
-        app = msal.PublicClientApplication("3b49f0d7-201a-4b5d-b2b4-8f4c3e6c8a30",
-                                           authority="https://login.microsoftonline.com/consumers",
-                                           token_cache=mscache)
+            self.app = msal.PublicClientApplication(outlook_client_id,
+                                                    authority="https://login.microsoftonline.com/consumers",
+                                                    token_cache=self.token_cache)
+        return self.app
 
+    def acquire_token(self, force_refresh=False):
+        """
+        Gets a token from MSAL, which refreshes it if needed, or logs in with the device flow if there's none
+        """
+        app = self.get_app()
         result = None
 
         accounts = app.get_accounts()
 
         if accounts:
             chosen = accounts[0]
-            result = app.acquire_token_silent(["https://graph.microsoft.com/Calendars.Read"], account=chosen)
+            result = app.acquire_token_silent(outlook_scopes, account=chosen, force_refresh=force_refresh)
 
         if not result:
             logging.info("No token exists in cache, login is required.")
 
-            flow = app.initiate_device_flow(scopes=["https://graph.microsoft.com/Calendars.Read"])
+            flow = app.initiate_device_flow(scopes=outlook_scopes)
             if "user_code" not in flow:
                 raise ValueError(
                     "Fail to create device flow. Err: %s" % json.dumps(flow, indent=4))
@@ -56,9 +92,12 @@ class OutlookCalendar(BaseCalendarProvider):
         logging.debug(result)
 
         if "access_token" in result:
-            if mscache.has_state_changed:
-                open("outlooktoken.bin", "w").write(mscache.serialize())
+            if self.token_cache.has_state_changed:
+                open("outlooktoken.bin", "w").write(self.token_cache.serialize())
 
+            with self.token_lock:
+                self.access_token = result["access_token"]
+                self.token_expires_at = time.time() + int(result.get("expires_in", 0))
             return result["access_token"]
         else:
             logging.error(result.get("error"))
@@ -66,63 +105,155 @@ class OutlookCalendar(BaseCalendarProvider):
             logging.error(result.get("correlation_id"))
             raise Exception(result.get("error"))
 
-    def get_outlook_calendar_events(self, calendar_id, from_date, to_date, access_token):
+    def refresh_token_in_background(self):
+        def refresh():
+            try:
+                self.acquire_token(force_refresh=True)
+            except Exception as error:
+                logging.error("Background refresh of the Outlook token failed - {}".format(error))
+            finally:
+                self.refreshing_token = False
 
-        from_date_iso = from_date.replace(microsecond=0).isoformat()
-        to_date_iso = to_date.isoformat()
+        with self.token_lock:
+            if self.refreshing_token:
+                return
+            self.refreshing_token = True
+        threading.Thread(target=refresh, daemon=True).start()
 
-        headers = {'Authorization': 'Bearer ' + access_token}
-        endpoint_calendar_view = \
-            "https://graph.microsoft.com/v1.0/me/calendars/{0}/calendarview?startdatetime={1}&enddatetime={2}&$orderby=start/dateTime&$top={3}"
-        events_data = requests.get(
-                                  endpoint_calendar_view.format(calendar_id,
-                                                                requests.utils.quote(from_date_iso),
-                                                                requests.utils.quote(to_date_iso),
-                                                                self.max_event_results),
-                                  headers=headers).json()
-        return events_data
+    def get_access_token(self):
+        """
+        Returns the token kept in memory while it's valid.
+        When it's close to expiring it's still used, and a fresh one is fetched in the background for next time.
+        """
+        with self.token_lock:
+            access_token = self.access_token
+            remaining = self.token_expires_at - time.time()
 
-    def get_calendar_events(self, bypass_cache=False) -> list[CalendarEvent]:
-        calendar_events = []
-        outlook_calendar_pickle = 'cache_outlookcalendar.pickle'
-        if bypass_cache or is_stale(os.getcwd() + "/" + outlook_calendar_pickle, ttl):
-            logging.debug("Cache is stale, calling the Outlook Calendar API")
-
-            access_token = self.get_access_token()
-            events_data = self.get_outlook_calendar_events(
-                self.outlook_calendar_id,
-                self.from_date,
-                self.to_date,
-                access_token)
-            logging.debug(events_data)
-
-            if not bypass_cache:
-                with open(outlook_calendar_pickle, 'wb') as cal:
-                    pickle.dump(events_data, cal)
+        if access_token and remaining > 0:
+            if remaining < outlook_token_refresh_margin:
+                self.refresh_token_in_background()
+            return access_token
+        return self.acquire_token()
+
+    def get_delta_url(self, window_start, window_end):
+        endpoint_calendar_view_delta = \
+            "https://graph.microsoft.com/v1.0/me/calendars/{0}/calendarView/delta?startDateTime={1}&endDateTime={2}"
+        return endpoint_calendar_view_delta.format(
+            self.outlook_calendar_id,
+            requests.utils.quote(window_start.replace(microsecond=0).isoformat()),
+            requests.utils.quote(window_end.replace(microsecond=0).isoformat()))
+
+    def parse_event(self, event) -> CalendarEvent:
+        start_date = datetime.datetime.strptime(event["start"]["dateTime"], "%Y-%m-%dT%H:%M:%S.0000000")
+        end_date = datetime.datetime.strptime(event["end"]["dateTime"], "%Y-%m-%dT%H:%M:%S.0000000")
+
+        summary = event["subject"]
+        is_all_day = event['isAllDay']
+
+        # Outlook Calendar marks the 'end' of all-day-events as
+        # the day _after_ the last day. eg, Today's all day event ends tomorrow midnight.
+        # So subtract a day
+        if is_all_day:
+            end_date = end_date - datetime.timedelta(days=1)
         else:
-            logging.info("Found in cache")
-            with open(outlook_calendar_pickle, 'rb') as cal:
-                events_data = pickle.load(cal)
-
-        for event in events_data["value"]:
-            start_date = datetime.datetime.strptime(event["start"]["dateTime"], "%Y-%m-%dT%H:%M:%S.0000000")
-            end_date = datetime.datetime.strptime(event["end"]["dateTime"], "%Y-%m-%dT%H:%M:%S.0000000")
-
-            summary = event["subject"]
-            is_all_day = event['isAllDay']
-
-            # Outlook Calendar marks the 'end' of all-day-events as
-            # the day _after_ the last day. eg, Today's all day event ends tomorrow midnight.
-            # So subtract a day
-            if is_all_day:
-                end_date = end_date - datetime.timedelta(days=1)
+            # Convert start/end to local time
+            start_date = start_date.replace(tzinfo=tz.tzutc())
+            start_date = start_date.astimezone(tz.tzlocal())
+            end_date = end_date.replace(tzinfo=tz.tzutc())
+            end_date = end_date.astimezone(tz.tzlocal())
+
+        return CalendarEvent(summary, start_date, end_date, is_all_day, event.get("iCalUId"))
+
+    def merge_events(self, events, values):
+        """
+        Applies a page of changes to the events by id, and returns them.
+        Events are parsed once here, and kept as `CalendarEvent`s.
+        """
+        for value in values:
+            if "@removed" in value or value.get("isCancelled"):
+                events.pop(value["id"], None)
             else:
-                # Convert start/end to local time
-                start_date = start_date.replace(tzinfo=tz.tzutc())
-                start_date = start_date.astimezone(tz.tzlocal())
-                end_date = end_date.replace(tzinfo=tz.tzutc())
-                end_date = end_date.astimezone(tz.tzlocal())
+                events[value["id"]] = self.parse_event(value)
+        return events
+
+    def covers_window(self, state):
+        """
+        Whether the state's delta query window still holds the days to show. A deltaLink keeps its first window.
+        """
+        to_date = self.to_date.astimezone(tz.tzutc()).replace(tzinfo=None)
+        return state.window_start <= self.from_date and state.window_end >= to_date
+
+    def sync_events(self, state, access_token):
+        """
+        Follows the delta query from the state's deltaLink, or starts a new one if there's no state,
+        or the days to show have moved out of its window. Returns the new `OutlookSyncState`.
+        """
+        headers = {'Authorization': 'Bearer ' + access_token, 'Prefer': 'odata.maxpagesize=200'}
+
+        to_date = self.to_date.astimezone(tz.tzutc()).replace(tzinfo=None)
+        if state and state.delta_link and self.covers_window(state):
+            url = state.delta_link
+            events = dict(state.events)
+            window_start, window_end = state.window_start, state.window_end
+        else:
+            window_start = self.from_date
+            window_end = to_date + datetime.timedelta(days=outlook_delta_extra_days)
+            url = self.get_delta_url(window_start, window_end)
+            events = {}
+
+        changed = 0
+        while url:
+            response = http_session.get(url, headers=headers, timeout=http_timeout)
+            if response.status_code == 410 and state:
+                logging.info("The deltaLink has expired, starting the delta query again")
+                return self.sync_events(None, access_token)
+            response.raise_for_status()
+            events_data = response.json()
+            events = self.merge_events(events, events_data.get("value", []))
+            changed += len(events_data.get("value", []))
+            url = events_data.get("@odata.nextLink")
+
+        logging.info("Outlook sync - {} events, {} changed".format(len(events), changed))
+        return OutlookSyncState(events_data.get("@odata.deltaLink"), window_start, window_end, events)
 
-            calendar_events.append(CalendarEvent(summary, start_date, end_date, is_all_day))
+    def get_local_time(self, value):
+        # All day events are naive, on the local clock; the others are already in local time
+        return value.replace(tzinfo=tz.tzlocal()) if value.tzinfo is None else value
 
-        return calendar_events
+    def iter_selected(self, events):
+        """
+        Yields the events between the from and to dates, earliest first
+        """
+        from_date = self.get_from_date()
+
+        for event in sorted(events, key=lambda event: self.get_local_time(event.start)):
+            if self.get_local_time(event.start) >= self.to_date:
+                return
+            # The end of an all day event is the start of its last day
+            end = self.get_local_time(event.end) + datetime.timedelta(days=1 if event.all_day_event else 0)
+            if end >= from_date:
+                yield event
+
+    def select_events(self, events) -> list[CalendarEvent]:
+        return list(itertools.islice(self.iter_selected(events), self.max_event_results))
+
+    def parse_events(self, events_data) -> list[CalendarEvent]:
+        """
+        Turns a calendarView response into `CalendarEvent`s
+        """
+        return self.select_events(self.merge_events({}, events_data["value"]).values())
+
+    def get_state(self, bypass_cache=False):
+        cache_key = make_cache_key("calendar", "OutlookCalendar", "delta", self.outlook_calendar_id)
+        return self.get_synced_state(
+            cache_key,
+            lambda state: self.sync_events(state, self.get_access_token()),
+            is_current=self.covers_window,
+            bypass_cache=bypass_cache,
+        )
+
+    def iter_calendar_events(self, bypass_cache=False):
+        yield from self.iter_selected(self.get_state(bypass_cache).events.values())
+
+    def get_calendar_events(self, bypass_cache=False) -> list[CalendarEvent]:
+        return list(itertools.islice(self.iter_calendar_events(bypass_cache), self.max_event_results))
@@ -0,0 +1,56 @@
+import logging
+import time
+from cache_store import get_cache_store, make_cache_key
+
+# How long a circuit breaker's state is kept in the cache store, in seconds
+breaker_state_ttl = 7 * 24 * 60 * 60
+
+
+class CircuitBreaker:
+    """
+    Stops calling something that keeps failing.
+    After `failure_threshold` failures in a row the breaker opens, and calls are skipped for `cooldown` seconds.
+    Then one call is let through; if it fails the breaker opens again straight away.
+    The state is kept in the cache store, so it carries over between runs of run.sh.
+    """
+
+    def __init__(self, name, failure_threshold, cooldown):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.cache_key = make_cache_key("circuit_breaker", name)
+
+    def get_state(self):
+        entry = get_cache_store().get(self.cache_key)
+        if entry is None:
+            return {"failures": 0, "open_until": 0}
+        return entry.value
+
+    def set_state(self, state):
+        get_cache_store().set(self.cache_key, state, breaker_state_ttl)
+
+    def is_open(self):
+        open_until = self.get_state()["open_until"]
+        if time.time() < open_until:
+            logging.debug(
+                "CircuitBreaker({}) - Open for another {:.0f}s".format(self.name, open_until - time.time())
+            )
+            return True
+        return False
+
+    def record_success(self):
+        state = self.get_state()
+        if state["failures"]:
+            logging.info("CircuitBreaker({}) - Closed".format(self.name))
+            self.set_state({"failures": 0, "open_until": 0})
+
+    def record_failure(self):
+        state = self.get_state()
+        failures = state["failures"] + 1
+        open_until = 0
+        if failures >= self.failure_threshold:
+            open_until = time.time() + self.cooldown
+            logging.warning(
+                "CircuitBreaker({}) - {} failures, skipping it for {:.0f}s".format(self.name, failures, self.cooldown)
+            )
+        self.set_state({"failures": failures, "open_until": open_until})
@@ -5,6 +5,7 @@ import logging
 import datetime
 from PIL import Image
 from utility import configure_logging
+from display import clear_last_frame_hash
 
 libdir = "./lib/e-Paper/RaspberryPi_JetsonNano/python/lib"
 if os.path.exists(libdir):
@@ -32,6 +33,9 @@ try:
     epd.sleep()
     epd.Dev_exit()
 
+    # The next frame must be drawn even if it's the same as before the clear
+    clear_last_frame_hash()
+
 except IOError as e:
     logging.exception(e)
 
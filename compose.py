@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+import sys
+import time
+
+# Measure how long the imports take, that's the cold start cost that run.sh pays on every cycle
+startup_time = time.monotonic()
+
+# With --startup-profile every import is timed, and the breakdown is printed once the providers are created.
+# Only when run as a script; daemon.py does the same for its own imports.
+profile_startup = __name__ == "__main__" and "--startup-profile" in sys.argv
+if profile_startup:
+    import startup_profile
+
+    startup_profile.enable()
+
+import codecs  # noqa: E402
+import importlib  # noqa: E402
+import logging  # noqa: E402
+import os  # noqa: E402
+import threading  # noqa: E402
+from utility import (  # noqa: E402
+    render_svg,
+    get_template_svg_filename,
+    configure_logging,
+    configure_locale,
+    cache_max_staleness,
+)
+from cache_store import get_cache_store, make_cache_key  # noqa: E402
+from spans import record_span, write_metrics  # noqa: E402
+from rasterize import write_debug_output  # noqa: E402
+from icon_atlas import rasterize_svg_with_atlas  # noqa: E402
+from native_render import is_native_layout, rasterize_output  # noqa: E402
+import display  # noqa: E402
+
+screen_calendar_get = importlib.import_module("screen-calendar-get")
+screen_weather_get = importlib.import_module("screen-weather-get")
+
+configure_locale()
+configure_logging()
+
+# Only written with WRITE_DEBUG_OUTPUT, the layout is rasterized in-process
+output_svg_filename = "screen-output-weather.svg"
+custom_svg_filename = "screen-output-custom-temp.svg"
+
+# How long, in seconds, the calendar, weather and alert fetches have in total before the cycle moves on
+fetch_deadline = float(os.getenv("FETCH_DEADLINE", 30))
+
+# How long, in seconds, compose.py waits on exit for fetches that missed the deadline, so their results are kept
+fetch_exit_grace = float(os.getenv("FETCH_EXIT_GRACE", 10))
+
+# What the weather, alert and calendar placeholders show when there's nothing to fill them with,
+# rather than the placeholder names. icons/blank.svg is an empty icon.
+empty_output = {
+    "WEATHER_NOW": "",
+    "WEATHER_ICON_NOW": "blank",
+    "ALERT_MESSAGE": "",
+    "ALERT_MESSAGE_VISIBILITY": "hidden",
+    "CAL_EVENTS": "",
+}
+
+# Fetches that are still running, so that a slow fetch isn't started again on top of itself
+running_fetches = {}
+
+
+def run_stage(timings, name, stage, *args):
+    """
+    Runs one stage of the cycle, recording how long it took.
+    A failing stage is logged and the cycle carries on, like run.sh does.
+    Returns the stage's result, or None if it failed.
+    """
+    result = None
+    outcome = "ok"
+    stage_start = time.monotonic()
+    try:
+        result = stage(*args)
+    except Exception as error:
+        logging.exception(error)
+        outcome = "error"
+    timings[name] = time.monotonic() - stage_start
+    record_span("stage." + name, timings[name], outcome=outcome)
+    return result
+
+
+def get_last_result(name):
+    """
+    Returns the last good result of a fetch, if it's no older than CACHE_MAX_STALENESS.
+    It's kept in the cache store, so that each run of run.sh can fall back on the one before.
+    """
+    cache_entry = get_cache_store().get(make_cache_key("last_result", name))
+    if cache_entry and cache_entry.get_age() <= cache_max_staleness:
+        return cache_entry.value
+    return None
+
+
+def set_last_result(name, result):
+    get_cache_store().set(make_cache_key("last_result", name), result, cache_max_staleness)
+
+
+def run_stages_concurrently(timings, stages, deadline):
+    """
+    Runs each (name, stage, args) in its own thread, and waits for them until the `deadline` (a time.monotonic() value).
+    A stage that fails or misses the deadline gets its last good result instead.
+    Threads that miss the deadline carry on in the background. In the daemon they're done by the next cycle;
+    compose.py gives them FETCH_EXIT_GRACE seconds with join_running_fetches() before it exits.
+    Returns a dict of name -> result.
+    """
+    # name -> (result, seconds) for each stage that has finished. Each thread times itself into its own dict,
+    # and only the stages that finished before the deadline are copied into `timings`
+    finished = {}
+    finished_lock = threading.Lock()
+
+    def run(name, stage, args):
+        stage_timings = {}
+        result = run_stage(stage_timings, name, stage, *args)
+        if result is not None:
+            try:
+                set_last_result(name, result)
+            except Exception as error:
+                logging.warning("Unable to keep the result of {}: {}".format(name, error))
+        with finished_lock:
+            finished[name] = (result, stage_timings[name])
+
+    threads = {}
+    for name, stage, args in stages:
+        if name in running_fetches and running_fetches[name].is_alive():
+            logging.warning("{} is still running from the last cycle".format(name))
+            continue
+        thread = threading.Thread(target=run, args=(name, stage, args), daemon=True)
+        thread.start()
+        threads[name] = running_fetches[name] = thread
+
+    for thread in threads.values():
+        thread.join(max(0, deadline - time.monotonic()))
+
+    with finished_lock:
+        done = dict(finished)
+
+    results = {}
+    for name, stage, args in stages:
+        if name in done:
+            results[name], timings[name] = done[name]
+        if results.get(name) is None:
+            if name in threads and name not in done:
+                logging.warning("{} missed the fetch deadline, using its last result".format(name))
+            else:
+                logging.warning("{} has no result, using its last result".format(name))
+            results[name] = get_last_result(name)
+
+    return results
+
+
+def join_running_fetches(timeout):
+    """
+    Waits up to `timeout` seconds in all for fetches that are still running, so that their last result is saved
+    """
+    deadline = time.monotonic() + timeout
+    for name, thread in running_fetches.items():
+        if thread.is_alive():
+            logging.info("Waiting for {} to finish".format(name))
+            thread.join(max(0, deadline - time.monotonic()))
+
+
+def get_custom_module():
+    if os.path.isfile("screen-custom-get.py"):
+        return importlib.import_module("screen-custom-get")
+    return None
+
+
+def update_custom_svg(custom_module):
+    """
+    The custom data is its own SVG, which the templates reference with <use href="screen-output-custom-temp.svg">
+    """
+    if custom_module:
+        custom_module.main()
+    elif not os.path.isfile(custom_svg_filename):
+        # Create temporary empty svg since the main SVG needs it
+        with open(custom_svg_filename, "w") as custom_svg:
+            custom_svg.write("<svg />\n")
+
+
+def create_providers():
+    """
+    Returns the calendar and weather providers, for callers that keep them, like daemon.py
+    """
+    calendar_provider = screen_calendar_get.get_calendar_provider(*screen_calendar_get.get_calendar_date_range())
+    location_lat, location_long = screen_weather_get.get_location()
+    units, _ = screen_weather_get.get_units()
+    weather_provider = screen_weather_get.get_weather_provider(location_lat, location_long, units)
+    return calendar_provider, weather_provider
+
+
+def get_output_dict(calendar_provider=None, weather_provider=None, timings=None):
+    """
+    Collects the fragment from each stage into one output dict.
+    The calendar, weather and alerts are fetched concurrently, within FETCH_DEADLINE seconds.
+    The calendar is formatted last so that its day headings can show each day's forecast.
+    """
+    if timings is None:
+        timings = {}
+
+    results = run_stages_concurrently(
+        timings,
+        [
+            ("weather", screen_weather_get.get_weather_output, (weather_provider,)),
+            ("alert", screen_weather_get.get_alert_output, ()),
+            ("calendar", screen_calendar_get.get_calendar_events, (calendar_provider,)),
+        ],
+        time.monotonic() + fetch_deadline,
+    )
+    weather_dict = results["weather"] or {}
+    alert_dict = results["alert"] or {}
+    calendar_events = results["calendar"]
+
+    output_dict = dict(empty_output)
+    output_dict.update(weather_dict)
+    output_dict.update(alert_dict)
+    output_dict.update(screen_weather_get.get_time_output())
+    if calendar_events is not None:
+        # A calendar that can't be formatted leaves its placeholder empty, like one that couldn't be fetched
+        calendar_dict = run_stage(
+            timings, "calendar_format", screen_calendar_get.get_calendar_output, calendar_events, weather_dict
+        )
+        output_dict.update(calendar_dict or {})
+
+    return output_dict
+
+
+def render(output_dict):
+    """
+    Renders the chosen layout once, with the whole output dict.
+    """
+    return render_svg(get_template_svg_filename(), output_dict)
+
+
+def write_output_svg(output):
+    logging.debug("write_output_svg() - Write to SVG {}".format(output_svg_filename))
+    with codecs.open(output_svg_filename, "w", encoding="utf-8") as output_file:
+        output_file.write(output)
+
+
+def get_output_image(output_dict, timings):
+    """
+    Renders the chosen layout and rasterizes it in-process, for display.display_image().
+    With RENDER_BACKEND=native, layouts that support it are drawn straight onto the image, see native_render.py.
+    The SVG is only written to `output_svg_filename` with WRITE_DEBUG_OUTPUT.
+    Returns the image, or None if it couldn't be rendered.
+    """
+    template_svg_filename = get_template_svg_filename()
+    if is_native_layout(template_svg_filename):
+        image = run_stage(timings, "rasterize", rasterize_output, output_dict, template_svg_filename)
+        if image is not None:
+            return image
+
+    svg = run_stage(timings, "render", render, output_dict)
+    if svg is None:
+        return None
+    if write_debug_output:
+        write_output_svg(svg)
+    return run_stage(timings, "rasterize", rasterize_svg_with_atlas, svg, template_svg_filename)
+
+
+def main():
+    if profile_startup:
+        # The providers import their own libraries when they're created, so they're timed too
+        create_providers()
+        startup_profile.report(time.monotonic() - startup_time)
+        return
+
+    timings = {}
+    update_custom_svg(get_custom_module())
+    output_dict = get_output_dict(timings=timings)
+
+    logging.info("Updating screen")
+    image = get_output_image(output_dict, timings)
+    if image is not None:
+        run_stage(timings, "display", display.display_image, image)
+    join_running_fetches(fetch_exit_grace)
+    write_metrics()
+
+
+if __name__ == "__main__":
+    main()
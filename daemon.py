@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+import sys
+import time
+
+# Measure how long the imports take, that's the cold start cost that run.sh pays on every cycle
+startup_time = time.monotonic()
+
+# With --startup-profile every import is timed, and the breakdown is printed once the providers are created
+profile_startup = "--startup-profile" in sys.argv
+if profile_startup:
+    import startup_profile
+
+    startup_profile.enable()
+
+import logging  # noqa: E402
+import os  # noqa: E402
+from utility import configure_logging, configure_locale  # noqa: E402
+from compose import (  # noqa: E402
+    run_stage,
+    get_custom_module,
+    update_custom_svg,
+    get_output_dict,
+    create_providers,
+    get_output_image,
+)
+import display  # noqa: E402
+import spans  # noqa: E402
+
+screen_custom_get = get_custom_module()
+
+configure_locale()
+configure_logging()
+
+# How often, in seconds, to refresh the screen
+daemon_interval = float(os.getenv("DAEMON_INTERVAL", 60))
+
+
+def run_cycle(calendar_provider, weather_provider):
+    timings = {}
+    cycle_start = time.monotonic()
+    spans.start_cycle()
+
+    run_stage(timings, "custom", update_custom_svg, screen_custom_get)
+    output_dict = get_output_dict(calendar_provider, weather_provider, timings)
+    image = get_output_image(output_dict, timings)
+    if image is not None:
+        run_stage(timings, "display", display.display_image, image)
+
+    timings["total"] = time.monotonic() - cycle_start
+    spans.record_span("cycle", timings["total"])
+    spans.write_metrics()
+    logging.info(
+        "Cycle timings - {}".format(
+            ", ".join("{}: {:.2f}s".format(k, v) for k, v in timings.items())
+        )
+    )
+    return timings
+
+
+def main():
+    logging.info(
+        "Startup imports took {:.2f}s".format(time.monotonic() - startup_time)
+    )
+
+    # Providers are kept alive between cycles so they can hold on to clients and tokens
+    calendar_provider, weather_provider = create_providers()
+
+    if profile_startup:
+        startup_profile.report(time.monotonic() - startup_time)
+        return
+
+    try:
+        while True:
+            try:
+                run_cycle(calendar_provider, weather_provider)
+            except Exception as error:
+                # A failed cycle is logged, and the next one is tried on schedule
+                logging.exception(error)
+            # Wake up on the interval boundary, the same as a cron job would
+            time.sleep(daemon_interval - time.time() % daemon_interval)
+    except KeyboardInterrupt:
+        logging.debug("Keyboard Interrupt - Exit")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,14 @@ import sys
 import os
 import logging
 import datetime
+import hashlib
+import time
 from PIL import Image
-from utility import configure_logging
+from spans import span, record_span, write_metrics
+from utility import configure_logging, get_template_svg_filename
+from icon_atlas import rasterize_svg_with_atlas
+from frame_diff import get_dirty_regions, get_region_area, get_region_buffer
+from frame_pack import get_white_byte, pack_frame, pack_planes
 
 libdir = "./lib/e-Paper/RaspberryPi_JetsonNano/python/lib"
 if os.path.exists(libdir):
@@ -16,46 +22,235 @@ configure_logging()
 
 waveshare_epd75_version = os.getenv("WAVESHARE_EPD75_VERSION", "2")
 
-if waveshare_epd75_version == "1":
-    from waveshare_epd import epd7in5 as epd7in5
-elif waveshare_epd75_version == "2B":
-    from waveshare_epd import epd7in5b_V2 as epd7in5
-else:
-    from waveshare_epd import epd7in5_V2 as epd7in5
+# Set to 1 to always refresh the screen, even if the image hasn't changed
+display_force_refresh = os.getenv("DISPLAY_FORCE_REFRESH", "0") == "1"
 
-try:
-    epd = epd7in5.EPD()
-    logging.debug("Initialize screen")
-    epd.init()
+# Set to 1 to only redraw the changed parts of the screen, on the 7.5 inch V2
+display_partial_refresh = os.getenv("DISPLAY_PARTIAL_REFRESH", "0") == "1"
+
+# If more than this fraction of the screen has changed, do a full refresh instead
+display_partial_refresh_max_area = float(os.getenv("DISPLAY_PARTIAL_REFRESH_MAX_AREA", 0.3))
+
+# Stores the hash of the last frame sent to the screen
+last_frame_hash_filename = "cache_display_hash.txt"
+
+# Stores the last frame sent to the screen, for working out what changed
+last_frame_filename = "cache_display_frame.bin"
+
+
+def get_epd_module():
+    """
+    Imports the Waveshare driver for the configured screen version.
+    Done on first use so that the render daemon can start without a panel attached.
+    """
+    if waveshare_epd75_version == "1":
+        from waveshare_epd import epd7in5 as epd7in5
+    elif waveshare_epd75_version == "2B":
+        from waveshare_epd import epd7in5b_V2 as epd7in5
+    else:
+        from waveshare_epd import epd7in5_V2 as epd7in5
+    return epd7in5
+
+
+def get_last_frame_hash():
+    if os.path.isfile(last_frame_hash_filename):
+        with open(last_frame_hash_filename, "r") as hash_file:
+            return hash_file.read().strip()
+    return None
+
+
+def save_last_frame_hash(frame_hash):
+    # Written to a temporary file first, so that a killed process never leaves a truncated file behind
+    temp_filename = last_frame_hash_filename + ".tmp"
+    with open(temp_filename, "w") as hash_file:
+        hash_file.write(frame_hash)
+    os.replace(temp_filename, last_frame_hash_filename)
+
+
+def clear_last_frame_hash():
+    """
+    Call this when the screen has been changed some other way, so the next frame is always shown.
+    """
+    for filename in [last_frame_hash_filename, last_frame_filename]:
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+
+def get_last_frame():
+    if os.path.isfile(last_frame_filename):
+        with open(last_frame_filename, "rb") as frame_file:
+            return frame_file.read()
+    return None
+
+
+def save_last_frame(frame_buffer):
+    temp_filename = last_frame_filename + ".tmp"
+    with open(temp_filename, "wb") as frame_file:
+        frame_file.write(bytes(frame_buffer))
+    os.replace(temp_filename, last_frame_filename)
+
+
+def supports_partial_refresh(epd):
+    return (
+        display_partial_refresh
+        and waveshare_epd75_version == "2"
+        and hasattr(epd, "init_part")
+        and hasattr(epd, "display_Partial")
+    )
+
+
+def get_partial_regions(epd, frame_buffer):
+    """
+    Returns the dirty regions between the last frame and this one,
+    or None if a full refresh should be done instead.
+    """
+    last_frame = get_last_frame()
+    if last_frame is None or len(last_frame) != len(frame_buffer):
+        return None
+
+    regions = get_dirty_regions(last_frame, frame_buffer, epd.width, epd.height)
+    dirty_area = get_region_area(regions)
+    if dirty_area > display_partial_refresh_max_area * epd.width * epd.height:
+        logging.info("{} pixels have changed, doing a full refresh".format(dirty_area))
+        return None
+    return regions
 
-    # Full screen refresh at 2 AM
-    if datetime.datetime.now().minute == 0 and datetime.datetime.now().hour == 2:
-        logging.debug("Clear screen")
-        epd.Clear()
 
-    filename = sys.argv[1]
+class BusyTimer:
+    """
+    Wraps the driver's ReadBusy(), to tell the time spent waiting for the panel to refresh
+    apart from the time spent sending it data
+    """
+
+    def __init__(self, epd):
+        self.busy_time = 0.0
+        if not hasattr(epd, "ReadBusy"):
+            return
+        read_busy = epd.ReadBusy
+
+        def timed_read_busy(*args):
+            start = time.monotonic()
+            try:
+                return read_busy(*args)
+            finally:
+                self.busy_time += time.monotonic() - start
+
+        epd.ReadBusy = timed_read_busy
+
+    def run(self, name, command, *args):
+        """
+        Runs a driver command, recording the time it spent waiting for the panel as `name`.refresh
+        and the rest as `name`.transfer
+        """
+        busy_before = self.busy_time
+        start = time.monotonic()
+        command(*args)
+        busy_time = self.busy_time - busy_before
+        record_span(name + ".transfer", time.monotonic() - start - busy_time)
+        record_span(name + ".refresh", busy_time)
+
+
+def display_image(Himage, force=False):
+    """
+    Sends a PIL image to the e-paper screen, then puts the screen to sleep.
+    If the packed frame is identical to the last one shown, the screen isn't touched at all,
+    unless `force` or DISPLAY_FORCE_REFRESH is set.
+    Returns whether the screen was refreshed.
+    """
+    epd7in5 = get_epd_module()
+    epd = epd7in5.EPD()
+    busy_timer = BusyTimer(epd)
 
-    logging.debug("Read image file: " + filename)
-    Himage = Image.open(filename)
     # rotate image 90 degrees counter clockwise
     # Himage = Himage.rotate(90)
 
-    logging.info("Display image file on screen")
+    with span("pack"):
+        white_byte = get_white_byte(epd)
+        if waveshare_epd75_version == "2B":
+            frame_buffers = pack_planes(Himage, epd.width, epd.height, white_byte)
+        else:
+            frame_buffers = [pack_frame(Himage, epd.width, epd.height, white_byte)]
+
+    frame_hash = hashlib.sha256()
+    for frame_buffer in frame_buffers:
+        frame_hash.update(bytes(frame_buffer))
+    frame_hash = frame_hash.hexdigest()
+
+    # Full screen refresh at 2 AM
+    clear_screen = datetime.datetime.now().minute == 0 and datetime.datetime.now().hour == 2
+
+    if not (force or display_force_refresh or clear_screen) and frame_hash == get_last_frame_hash():
+        logging.info("Frame is unchanged, skipping the screen refresh")
+        return False
+
+    regions = None
+    if supports_partial_refresh(epd) and not (force or display_force_refresh or clear_screen):
+        regions = get_partial_regions(epd, frame_buffers[0])
 
-    if waveshare_epd75_version == "2B":
-        Limage_Other = Image.new(
-            "1", (epd.height, epd.width), 255
-        )  # 255: clear the frame
-        epd.display(epd.getbuffer(Himage), epd.getbuffer(Limage_Other))
+    if regions:
+        logging.debug("Initialize screen for partial refresh")
+        with span("epd.init", mode="partial"):
+            epd.init_part()
+
+        logging.info("Display {} changed regions on screen".format(len(regions)))
+        for region in regions:
+            x_start, y_start, x_end, y_end = region
+            busy_timer.run(
+                "epd.partial",
+                epd.display_Partial,
+                get_region_buffer(frame_buffers[0], epd.width, region),
+                x_start,
+                y_start,
+                x_end,
+                y_end,
+            )
     else:
-        epd.display(epd.getbuffer(Himage))
-    epd.sleep()
-    epd.Dev_exit()
+        logging.debug("Initialize screen")
+        with span("epd.init", mode="full"):
+            epd.init()
+
+        if clear_screen:
+            logging.debug("Clear screen")
+            busy_timer.run("epd.clear", epd.Clear)
+
+        logging.info("Display image file on screen")
+
+        busy_timer.run("epd.display", epd.display, *frame_buffers)
+
+    with span("epd.sleep"):
+        epd.sleep()
+        epd.Dev_exit()
+
+    # The frame is saved before its hash, so the hash never matches a frame that wasn't saved
+    if supports_partial_refresh(epd):
+        save_last_frame(frame_buffers[0])
+    save_last_frame_hash(frame_hash)
+    return True
+
+
+def main():
+    try:
+        filename = sys.argv[1]
+        force = "--force" in sys.argv[2:]
+
+        if filename.endswith(".svg"):
+            logging.debug("Rasterize SVG file: " + filename)
+            with open(filename, "r", encoding="utf-8") as svg_file:
+                Himage = rasterize_svg_with_atlas(svg_file.read(), get_template_svg_filename(), filename)
+        else:
+            logging.debug("Read image file: " + filename)
+            Himage = Image.open(filename)
+        display_image(Himage, force)
+        write_metrics()
+
+    except IOError as e:
+        logging.exception(e)
+
+    except KeyboardInterrupt:
+        logging.debug("Keyboard Interrupt - Exit")
+        get_epd_module().epdconfig.module_exit()
+        exit()
 
-except IOError as e:
-    logging.exception(e)
 
-except KeyboardInterrupt:
-    logging.debug("Keyboard Interrupt - Exit")
-    epd7in5.epdconfig.module_exit()
-    exit()
+if __name__ == "__main__":
+    main()
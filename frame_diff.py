@@ -0,0 +1,70 @@
+import logging
+
+
+def get_changed_byte_range(previous_row, current_row):
+    """
+    Returns the (first, last + 1) byte indexes that differ between two rows of equal length
+    """
+    first = 0
+    while previous_row[first] == current_row[first]:
+        first += 1
+    last = len(current_row)
+    while previous_row[last - 1] == current_row[last - 1]:
+        last -= 1
+    return first, last
+
+
+def get_dirty_regions(previous_frame, current_frame, width, height, merge_gap=8):
+    """
+    Compares two packed 1-bit frames, one bit per pixel, MSB first, `width` pixels per row.
+    Returns a list of dirty bounding boxes as (x_start, y_start, x_end, y_end) pixels, end exclusive.
+    The x coordinates are byte aligned, so each box can be sent to the panel as whole bytes.
+    Dirty rows less than `merge_gap` rows apart are merged into the same box.
+    """
+    row_bytes = width // 8
+    previous_frame = bytes(previous_frame)
+    current_frame = bytes(current_frame)
+
+    regions = []
+    box = None  # [first_byte, y_start, last_byte, y_end]
+
+    for y in range(height):
+        row_start = y * row_bytes
+        previous_row = previous_frame[row_start:row_start + row_bytes]
+        current_row = current_frame[row_start:row_start + row_bytes]
+        if previous_row == current_row:
+            continue
+
+        first, last = get_changed_byte_range(previous_row, current_row)
+        if box and y - box[3] < merge_gap:
+            box[0] = min(box[0], first)
+            box[2] = max(box[2], last)
+            box[3] = y + 1
+        else:
+            if box:
+                regions.append(box)
+            box = [first, y, last, y + 1]
+
+    if box:
+        regions.append(box)
+
+    regions = [(first * 8, y_start, last * 8, y_end) for first, y_start, last, y_end in regions]
+    logging.debug("get_dirty_regions() - {}".format(regions))
+    return regions
+
+
+def get_region_area(regions):
+    return sum((x_end - x_start) * (y_end - y_start) for x_start, y_start, x_end, y_end in regions)
+
+
+def get_region_buffer(frame, width, region):
+    """
+    Cuts a byte aligned `region` out of a packed frame, as its own packed buffer
+    """
+    row_bytes = width // 8
+    x_start, y_start, x_end, y_end = region
+    frame = bytes(frame)
+    return bytearray().join(
+        frame[y * row_bytes + x_start // 8:y * row_bytes + x_end // 8]
+        for y in range(y_start, y_end)
+    )
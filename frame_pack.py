@@ -0,0 +1,80 @@
+import logging
+import os
+import sys
+from PIL import Image
+from cache_store import get_cache_store, make_cache_key
+
+# How long to remember each driver's bit order, in seconds
+polarity_ttl = 365 * 24 * 60 * 60
+
+# The palette colours for splitting a colour image into black and red planes
+plane_palette = [255, 255, 255, 0, 0, 0, 255, 0, 0]
+
+
+def get_white_byte(epd):
+    """
+    Returns the byte a white stretch of the screen packs to, 0xFF or 0x00.
+    Waveshare's drivers don't agree on whether a set bit is black or white, so the answer comes from the driver's own
+    getbuffer(). That's slow on some drivers, so it's remembered for as long as the driver file doesn't change.
+    """
+    driver_name = type(epd).__module__
+    driver_filename = getattr(sys.modules.get(driver_name), "__file__", None)
+    driver_mtime = os.path.getmtime(driver_filename) if driver_filename else None
+    cache_key = make_cache_key("frame_polarity", driver_name, driver_filename, driver_mtime)
+
+    cache_entry = get_cache_store().get(cache_key)
+    if cache_entry:
+        return cache_entry.value
+
+    white_buffer = epd.getbuffer(Image.new("1", (epd.width, epd.height), 255))
+    white_byte = white_buffer[0] & 0xFF
+    logging.info("get_white_byte() - {} packs white as {:#04x}".format(driver_name, white_byte))
+    get_cache_store().set(cache_key, white_byte, polarity_ttl)
+    return white_byte
+
+
+def orient(image, width, height):
+    """
+    Returns `image` in the panel's landscape orientation.
+    The layouts are drawn in portrait, and are turned the same way as the drivers do, 90 degrees anticlockwise.
+    transpose() only moves pixels, so it's one quick pass in C.
+    """
+    if image.size == (width, height):
+        return image
+    if image.size == (height, width):
+        return image.transpose(Image.Transpose.ROTATE_90)
+    raise ValueError("The image is {}x{}, but the screen is {}x{}".format(image.width, image.height, width, height))
+
+
+def pack_frame(image, width, height, white_byte=0x00):
+    """
+    Packs an image into the panel's frame buffer, one bit per pixel, most significant bit first, `width` pixels per row.
+    PIL packs a "1" image in exactly that layout, and the "1;I" packer inverts the bits as it goes,
+    so there's no loop over the pixels or bytes in Python.
+    """
+    image = orient(image, width, height)
+    if image.mode != "1":
+        image = image.convert("1")
+    return bytearray(image.tobytes("raw", "1" if white_byte == 0xFF else "1;I"))
+
+
+def pack_planes(image, width, height, white_byte=0x00):
+    """
+    Packs an image into black and red frame buffers, for the 7.5 inch 2B.
+    Black and white images get an all white red plane, without drawing or packing a second image.
+    Colour images are split by mapping every pixel to white, black or red in one pass, and only that one byte per
+    pixel image is turned, rather than the RGB one.
+    """
+    if image.mode in ("1", "L"):
+        red_plane = bytearray([white_byte]) * (width * height // 8)
+        return [pack_frame(image, width, height, white_byte), red_plane]
+
+    palette_image = Image.new("P", (1, 1))
+    palette_image.putpalette(plane_palette + [0] * (768 - len(plane_palette)))
+    classified = orient(image.convert("RGB").quantize(palette=palette_image, dither=Image.Dither.NONE), width, height)
+
+    # Each plane is white everywhere except the pixels of its own colour. The planes are already in landscape,
+    # so pack_frame() only packs them.
+    black = classified.point([0 if index == 1 else 255 for index in range(256)], "1")
+    red = classified.point([0 if index == 2 else 255 for index in range(256)], "1")
+    return [pack_frame(black, width, height, white_byte), pack_frame(red, width, height, white_byte)]
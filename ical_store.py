@@ -0,0 +1,277 @@
+import datetime
+import hashlib
+import heapq
+import logging
+import re
+from typing import NamedTuple
+import icalendar
+from dateutil import rrule, tz
+
+# Matches a folded line in iCalendar text, which carries on the line before it
+folded_line_pattern = re.compile(r"\r?\n[ \t]")
+# Lines that change on every download without the event changing, eg. Google's feeds stamp every event with the time
+volatile_line_pattern = re.compile(r"^DTSTAMP[;:].*$", re.MULTILINE)
+uid_pattern = re.compile(r"^UID[;:](.*?)\r?$", re.MULTILINE)
+sequence_pattern = re.compile(r"^SEQUENCE[;:](\d+)", re.MULTILINE)
+recurrence_id_pattern = re.compile(r"^RECURRENCE-ID([;:].*?)\r?$", re.MULTILINE)
+until_pattern = re.compile(r"UNTIL=(\d{8}T\d{6})Z")
+
+
+class StoredEvent(NamedTuple):
+    """
+    The parts of a VEVENT needed to show it and to expand its recurrences.
+    Start and end are dates for all day events, otherwise datetimes, in the event's own time zone.
+    """
+
+    uid: str
+    sequence: int
+    recurrence_id: any
+    summary: str
+    start: any
+    end: any
+    rrule: str
+    rdates: list
+    exdates: list
+    cancelled: bool
+
+
+class EventInstance(NamedTuple):
+    """
+    One occurrence of an event, in the local time zone. The end of an all day event is its last day.
+    """
+
+    summary: str
+    start: any
+    end: any
+    all_day: bool
+    uid: str = None
+
+
+def unfold(text):
+    return folded_line_pattern.sub("", text)
+
+
+def split_vevents(text):
+    """
+    Yields the text of each VEVENT in an iCalendar feed, without parsing the feed
+    """
+    position = 0
+    while True:
+        start = text.find("BEGIN:VEVENT", position)
+        if start < 0:
+            return
+        end = text.find("END:VEVENT", start)
+        if end < 0:
+            return
+        position = end + len("END:VEVENT")
+        yield text[start:position]
+
+
+def get_vevent_key(text):
+    """
+    Returns (key, sequence, digest) for the text of a VEVENT.
+    The key is its UID and RECURRENCE-ID, which identify it in the feed;
+    the digest tells whether it changed without its SEQUENCE being raised, as some servers do.
+    """
+    text = unfold(text)
+    uid = uid_pattern.search(text)
+    recurrence_id = recurrence_id_pattern.search(text)
+    sequence = sequence_pattern.search(text)
+    digest = hashlib.sha1(volatile_line_pattern.sub("", text).encode("utf-8")).hexdigest()
+    key = (uid.group(1) if uid else digest, recurrence_id.group(1) if recurrence_id else None)
+    return key, int(sequence.group(1)) if sequence else 0, digest
+
+
+def get_dates(component, name):
+    """
+    Returns the dates or datetimes of a property that can be repeated and hold lists, like EXDATE
+    """
+    values = component.get(name)
+    if values is None:
+        return []
+    if not isinstance(values, list):
+        values = [values]
+    return [date.dt for value in values for date in value.dts]
+
+
+def parse_component(component):
+    """
+    Returns the `StoredEvent` for a parsed VEVENT component
+    """
+    start = component["DTSTART"].dt
+    if "DTEND" in component:
+        end = component["DTEND"].dt
+    elif "DURATION" in component:
+        end = start + component["DURATION"].dt
+    elif isinstance(start, datetime.datetime):
+        end = start
+    else:
+        end = start + datetime.timedelta(days=1)
+
+    return StoredEvent(
+        uid=str(component.get("UID", "")),
+        sequence=int(component.get("SEQUENCE", 0)),
+        recurrence_id=component["RECURRENCE-ID"].dt if "RECURRENCE-ID" in component else None,
+        summary=str(component.get("SUMMARY", "")),
+        start=start,
+        end=end,
+        rrule=component["RRULE"].to_ical().decode("utf-8") if "RRULE" in component else None,
+        rdates=get_dates(component, "RDATE"),
+        exdates=get_dates(component, "EXDATE"),
+        cancelled=str(component.get("STATUS", "")).upper() == "CANCELLED",
+    )
+
+
+def parse_recurrence(lines):
+    """
+    Returns the (rrule, rdates, exdates) of recurrence lines such as "RRULE:FREQ=WEEKLY" and "EXDATE;TZID=...",
+    the way Google and Outlook hand them out outside of a VEVENT
+    """
+    component = icalendar.Event.from_ical("BEGIN:VEVENT\r\n" + "\r\n".join(lines) + "\r\nEND:VEVENT")
+    rrule_text = component["RRULE"].to_ical().decode("utf-8") if "RRULE" in component else None
+    return rrule_text, get_dates(component, "RDATE"), get_dates(component, "EXDATE")
+
+
+def sync_events(stored_events, text):
+    """
+    Updates a store of events from the text of an iCalendar feed, and returns the new store.
+    The store maps (UID, RECURRENCE-ID) to (sequence, digest, `StoredEvent`).
+    Only the VEVENTs that are new, or whose SEQUENCE or text changed, are parsed again.
+    """
+    events = {}
+    parsed = 0
+    for vevent_text in split_vevents(text):
+        key, sequence, digest = get_vevent_key(vevent_text)
+        stored = stored_events.get(key)
+        if stored and stored[0] == sequence and stored[1] == digest:
+            events[key] = stored
+            continue
+        try:
+            component = icalendar.Event.from_ical(vevent_text)
+            events[key] = (sequence, digest, parse_component(component))
+            parsed += 1
+        except (ValueError, KeyError) as error:
+            logging.warning("sync_events() - Skipping an event that can't be read: {}".format(error))
+
+    logging.info("sync_events() - {} events, {} parsed, {} removed".format(
+        len(events), parsed, len(stored_events.keys() - events.keys())))
+    return events
+
+
+def get_tzinfo(value):
+    return getattr(value, "tzinfo", None) or tz.tzlocal()
+
+
+def to_wall_time(value, tzinfo):
+    """
+    Returns a date or datetime as a naive datetime on the clock of `tzinfo`.
+    Naive datetimes are floating times, they're already on the clock of wherever the screen is.
+    """
+    if not isinstance(value, datetime.datetime):
+        return datetime.datetime.combine(value, datetime.time.min)
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(tzinfo).replace(tzinfo=None)
+
+
+def from_wall_time(value, tzinfo):
+    if hasattr(tzinfo, "localize"):
+        # pytz time zones have to work out their offset for the date
+        return tzinfo.localize(value)
+    return value.replace(tzinfo=tzinfo)
+
+
+def to_local(value):
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=tz.tzlocal())
+    return value.astimezone(tz.tzlocal())
+
+
+def iter_occurrences(event, window_start, window_end):
+    """
+    Yields the start of each occurrence of `event` that overlaps the window, in order, as naive datetimes on the
+    event's clock. The window is aware datetimes. Recurrences are only expanded as they're asked for.
+    """
+    tzinfo = get_tzinfo(event.start)
+    start = to_wall_time(event.start, tzinfo)
+    duration = to_wall_time(event.end, tzinfo) - start
+    first = to_wall_time(window_start, tzinfo) - duration
+    last = to_wall_time(window_end, tzinfo)
+
+    if not event.rrule:
+        if first <= start <= last:
+            yield start
+        return
+
+    # The rule is expanded on the event's clock, so an UNTIL in UTC is moved onto it too
+    def until_on_clock(match):
+        until = datetime.datetime.strptime(match.group(1), "%Y%m%dT%H%M%S").replace(tzinfo=tz.tzutc())
+        return "UNTIL=" + to_wall_time(until, tzinfo).strftime("%Y%m%dT%H%M%S")
+
+    rule_set = rrule.rrulestr(
+        "RRULE:" + until_pattern.sub(until_on_clock, event.rrule), dtstart=start, forceset=True
+    )
+    for rdate in event.rdates:
+        rule_set.rdate(to_wall_time(rdate, tzinfo))
+    for exdate in event.exdates:
+        rule_set.exdate(to_wall_time(exdate, tzinfo))
+    for occurrence in rule_set.xafter(first, inc=True):
+        if occurrence > last:
+            return
+        yield occurrence
+
+
+def iter_event_instances(event, overrides, window_start, window_end):
+    """
+    Yields an `EventInstance` for each occurrence of one stored event in the window, skipping the `overrides`
+    """
+    all_day = not isinstance(event.start, datetime.datetime)
+    tzinfo = get_tzinfo(event.start)
+    duration = to_wall_time(event.end, tzinfo) - to_wall_time(event.start, tzinfo)
+
+    for occurrence in iter_occurrences(event, window_start, window_end):
+        if occurrence in overrides:
+            continue
+        if all_day:
+            # All day events end on the day after their last day
+            start = occurrence.date()
+            end = max(start, (occurrence + duration).date() - datetime.timedelta(days=1))
+        else:
+            start = to_local(from_wall_time(occurrence, tzinfo))
+            end = to_local(from_wall_time(occurrence + duration, tzinfo))
+        yield EventInstance(event.summary, start, end, all_day, event.uid)
+
+
+def iter_events(stored_events, window_start, window_end):
+    """
+    Yields an `EventInstance` for every occurrence of the stored events that overlaps the window, earliest first.
+    Each event's occurrences are merged with a heap, so only as many are expanded as are read.
+    Occurrences that were moved or cancelled (a VEVENT with a RECURRENCE-ID) replace the ones in the rule.
+    """
+    window_start = to_local(window_start)
+    window_end = to_local(window_end)
+
+    # UID -> the occurrences that have their own VEVENT, on the clock of their series
+    overridden = {}
+    for event in stored_events:
+        if event.recurrence_id is not None:
+            overridden.setdefault(event.uid, set()).add(event.recurrence_id)
+
+    streams = []
+    for event in stored_events:
+        if event.cancelled:
+            continue
+        tzinfo = get_tzinfo(event.start)
+        overrides = {
+            to_wall_time(recurrence_id, tzinfo) for recurrence_id in overridden.get(event.uid, ())
+        } if event.rrule else set()
+        streams.append(iter_event_instances(event, overrides, window_start, window_end))
+
+    return heapq.merge(*streams, key=lambda instance: to_wall_time(instance.start, tz.tzlocal()))
+
+
+def expand_events(stored_events, window_start, window_end):
+    """
+    Returns an `EventInstance` for every occurrence of the stored events that overlaps the window, earliest first
+    """
+    return list(iter_events(stored_events, window_start, window_end))
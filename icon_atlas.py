@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import xml.etree.ElementTree as ET
+from PIL import Image, ImageChops
+from rasterize import render_image, save_debug_output, rasterize_svg, get_screen_size
+from utility import configure_logging, get_template_svg_filename
+
+# Set to 1 to draw the weather icons from a pre-rasterized atlas, instead of rendering their SVGs on every cycle
+use_icon_atlas = os.getenv("ICON_ATLAS", "0") == "1"
+
+icons_dirname = "icons"
+atlas_magic = b"ICONATL1"
+atlas_header = struct.Struct("<8sI")
+
+# Matches a <use> of an icon in a rendered SVG, eg. <use id="currentweathericon" href="icons/01d.svg" />
+icon_use_pattern = re.compile(r"<use\b[^>]*?\bhref=\"icons/([^\"/]+)\.svg\"[^>]*/>")
+
+svg_namespace = "{http://www.w3.org/2000/svg}"
+xlink_href = "{http://www.w3.org/1999/xlink}href"
+
+# atlas filename -> IconAtlas
+atlas_cache = {}
+
+
+class IconAtlas:
+    """
+    Every icon, pre-rasterized at each icon slot of a template, as 1-bit masks in one file.
+    The file is a header, a JSON index and the packed masks, and is memory mapped rather than read.
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as atlas_file:
+            self.data = mmap.mmap(atlas_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_size = atlas_header.unpack_from(self.data)
+        if magic != atlas_magic:
+            raise ValueError("{} is not an icon atlas".format(filename))
+        index = json.loads(self.data[atlas_header.size:atlas_header.size + index_size])
+        self.data_start = atlas_header.size + index_size
+        self.size = tuple(index["size"])
+        self.sources = index["sources"]
+        self.slots = index["slots"]
+
+    def get_icon(self, slot, icon_name):
+        """
+        Returns the (x, y, mask) of an icon in a slot, or None if the atlas doesn't have it.
+        The mask is 1 where the icon is black.
+        """
+        entry = self.slots[slot].get(icon_name)
+        if entry is None:
+            return None
+        x, y, width, height, offset, length = entry
+        start = self.data_start + offset
+        mask = Image.frombytes("1", (width, height), self.data[start:start + length])
+        return x, y, mask
+
+
+def get_atlas_filename(template_svg_filename):
+    return "cache_icon_atlas.{}.bin".format(os.path.splitext(os.path.basename(template_svg_filename))[0])
+
+
+def get_icon_names():
+    return sorted(
+        os.path.splitext(filename)[0]
+        for filename in os.listdir(icons_dirname)
+        if filename.endswith(".svg")
+    )
+
+
+def get_sources(template_svg_filename):
+    """
+    Returns the files an atlas is built from, with their modification times
+    """
+    filenames = [template_svg_filename] + [
+        os.path.join(icons_dirname, icon_name + ".svg") for icon_name in get_icon_names()
+    ]
+    return {filename: os.stat(filename).st_mtime_ns for filename in filenames}
+
+
+def get_href(element):
+    return element.get("href") or element.get(xlink_href) or ""
+
+
+def get_icon_slots(root):
+    """
+    Returns the transforms of each icon <use> in the template, in document order.
+    Each slot is the list of transforms from the outermost group down to the <use> itself.
+    """
+    slots = []
+
+    def visit(element, transforms):
+        if element.get("transform"):
+            transforms = transforms + [element.get("transform")]
+        if element.tag == svg_namespace + "use" and get_href(element).startswith(icons_dirname + "/"):
+            x, y = element.get("x", "0"), element.get("y", "0")
+            slots.append(transforms + ["translate({} {})".format(x, y)])
+            return
+        for child in element:
+            visit(child, transforms)
+
+    for child in root:
+        visit(child, [])
+    return slots
+
+
+def get_slot_svg(root, transforms, icon_name):
+    """
+    Returns an SVG with only one icon, drawn where the template would draw it
+    """
+    attributes = " ".join(
+        '{}="{}"'.format(name, root.get(name))
+        for name in ("width", "height", "viewBox", "preserveAspectRatio")
+        if root.get(name) is not None
+    )
+    groups = "".join('<g transform="{}">'.format(transform) for transform in transforms)
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg" {}>'
+        '<rect width="100%" height="100%" fill="white"/>'
+        '{}<use href="{}/{}.svg"/>{}</svg>'
+    ).format(attributes, groups, icons_dirname, icon_name, "</g>" * len(transforms))
+
+
+def build_atlas(template_svg_filename, atlas_filename):
+    """
+    Rasterizes every icon at every icon slot of the template, and writes the atlas.
+    The file is written to a temporary name and then moved, so a half written atlas is never read.
+    """
+    logging.info("build_atlas() - Building {}".format(atlas_filename))
+    root = ET.parse(template_svg_filename).getroot()
+    slots = get_icon_slots(root)
+
+    size = None
+    index_slots = []
+    masks = bytearray()
+    for transforms in slots:
+        slot = {}
+        for icon_name in get_icon_names():
+            image = render_image(get_slot_svg(root, transforms, icon_name), template_svg_filename)
+            size = image.size
+            ink = ImageChops.invert(image.convert("L")).convert("1")
+            bbox = ink.getbbox()
+            if bbox is None:
+                continue
+            mask = ink.crop(bbox).tobytes()
+            slot[icon_name] = [bbox[0], bbox[1], bbox[2] - bbox[0], bbox[3] - bbox[1], len(masks), len(mask)]
+            masks += mask
+        index_slots.append(slot)
+
+    index = json.dumps(
+        {"size": size, "sources": get_sources(template_svg_filename), "slots": index_slots}
+    ).encode("utf-8")
+
+    temp_filename = atlas_filename + ".tmp"
+    with open(temp_filename, "wb") as atlas_file:
+        atlas_file.write(atlas_header.pack(atlas_magic, len(index)))
+        atlas_file.write(index)
+        atlas_file.write(masks)
+    os.replace(temp_filename, atlas_filename)
+    logging.info("build_atlas() - {} slots, {} bytes of masks".format(len(index_slots), len(masks)))
+
+
+def is_atlas_current(atlas, template_svg_filename, size):
+    return atlas.sources == get_sources(template_svg_filename) and atlas.size == size
+
+
+def get_atlas(template_svg_filename, size):
+    """
+    Returns the `IconAtlas` for a template, rendered at `size`.
+    It's rebuilt when the template or any icon has changed since it was built.
+    """
+    atlas_filename = get_atlas_filename(template_svg_filename)
+    atlas = atlas_cache.get(atlas_filename)
+
+    if atlas is None and os.path.isfile(atlas_filename):
+        try:
+            atlas = IconAtlas(atlas_filename)
+        except (ValueError, struct.error) as error:
+            logging.warning("get_atlas() - {}".format(error))
+
+    if atlas is None or not is_atlas_current(atlas, template_svg_filename, size):
+        build_atlas(template_svg_filename, atlas_filename)
+        atlas = IconAtlas(atlas_filename)
+
+    atlas_cache[atlas_filename] = atlas
+    return atlas
+
+
+def rasterize_svg_with_atlas(svg, template_svg_filename, base_url="screen-output-weather.svg"):
+    """
+    Like rasterize_svg(), but when ICON_ATLAS is set the icons are taken out of the SVG
+    and drawn from the template's atlas, so CairoSVG never has to parse and draw them.
+    Falls back to rendering the whole SVG if the icons don't line up with the atlas.
+    """
+    if not use_icon_atlas:
+        return rasterize_svg(svg, base_url)
+
+    icon_names = icon_use_pattern.findall(svg)
+    # The SVG is rendered in portrait
+    waveshare_width, waveshare_height = get_screen_size()
+    atlas = get_atlas(template_svg_filename, (waveshare_height, waveshare_width))
+
+    # The icons are checked against the atlas first, so that a mismatch only renders the SVG once
+    if len(icon_names) != len(atlas.slots):
+        logging.warning(
+            "rasterize_svg_with_atlas() - Found {} icons for {} slots, rendering them instead".format(
+                len(icon_names), len(atlas.slots)
+            )
+        )
+        return rasterize_svg(svg, base_url)
+
+    icons = []
+    for slot, icon_name in enumerate(icon_names):
+        icon = atlas.get_icon(slot, icon_name)
+        if icon is None and icon_name not in get_icon_names():
+            logging.warning("rasterize_svg_with_atlas() - No icon {}, rendering them instead".format(icon_name))
+            return rasterize_svg(svg, base_url)
+        # None when the icon is all white
+        icons.append(icon)
+
+    image = render_image(icon_use_pattern.sub("", svg), base_url)
+    for icon in icons:
+        if icon is not None:
+            x, y, mask = icon
+            image.paste(0, (x, y), mask)
+
+    save_debug_output(image)
+    return image
+
+
+def main():
+    configure_logging()
+    template_svg_filename = get_template_svg_filename()
+    atlas_filename = get_atlas_filename(template_svg_filename)
+    build_atlas(template_svg_filename, atlas_filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import functools
+import html
+import logging
+import os
+import re
+from typing import NamedTuple
+from PIL import Image, ImageChops, ImageDraw, ImageFilter, ImageFont
+from icon_atlas import get_atlas, get_icon_names
+from rasterize import get_screen_size, save_debug_output
+from spans import span
+
+# Set to native to draw the layouts that have a descriptor below with PIL, instead of rendering their SVG with CairoSVG.
+# Layouts without a descriptor are still rendered from their SVG.
+render_backend = os.getenv("RENDER_BACKEND", "svg")
+
+# The fonts to draw with. They should be the fonts that sans-serif is on the Pi, so the layout matches the SVG.
+native_font = os.getenv("NATIVE_FONT", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")
+native_bold_font = os.getenv("NATIVE_BOLD_FONT", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf")
+
+# The size the templates are drawn at
+template_width = 480
+
+# Matches each <tspan> in a text block such as CAL_EVENTS, with its attributes and text
+tspan_pattern = re.compile(r"<tspan\b([^>]*)>(.*?)</tspan>", re.DOTALL)
+cdata_pattern = re.compile(r"<!\[CDATA\[(.*?)\]\]>", re.DOTALL)
+
+
+class TextField(NamedTuple):
+    """
+    A value drawn as one line of text. `y` is the baseline, like in SVG, and `anchor` is start or middle.
+    """
+
+    key: str
+    x: float
+    y: float
+    font_size: float
+    anchor: str = "start"
+
+
+class TextBlock(NamedTuple):
+    """
+    A value that is a block of <tspan> lines, such as CAL_EVENTS, drawn from (x, y) down.
+    A tspan with dy="1em" starts a new line, the others carry on the line before.
+    """
+
+    key: str
+    x: float
+    y: float
+    font_size: float
+
+
+class IconField(NamedTuple):
+    """
+    A value that names an icon, drawn from the template's icon atlas. `slot` is the icon's place in the template.
+    """
+
+    key: str
+    slot: int
+
+
+# template filename -> the fields it draws, in the positions and sizes of the SVG
+template_layouts = {
+    "screen-template.7.svg": [
+        TextBlock("CAL_EVENTS", 0, 70, 25),
+        TextField("TIME_NOW", 0, 40, 38),
+        IconField("WEATHER_ICON_NOW", 0),
+        TextField("WEATHER_NOW", 322, 40, 38, "middle"),
+    ],
+}
+
+
+class NativeRenderError(Exception):
+    """
+    Raised when a layout can't be drawn natively, so that its SVG is rendered instead
+    """
+
+
+def is_native_layout(template_svg_filename):
+    return render_backend == "native" and os.path.basename(template_svg_filename) in template_layouts
+
+
+@functools.lru_cache(maxsize=None)
+def get_font(size, bold=False):
+    """
+    Returns the font at a size, loaded once per process
+    """
+    return ImageFont.truetype(native_bold_font if bold else native_font, size)
+
+
+@functools.lru_cache(maxsize=4096)
+def get_glyph(size, bold, character):
+    """
+    Returns (left, top, mask, advance) for a character, drawn once and then reused.
+    (left, top) is where the mask goes relative to the pen on the baseline.
+    """
+    font = get_font(size, bold)
+    left, top, right, bottom = font.getbbox(character, anchor="ls")
+    mask = Image.new("1", (max(1, right - left), max(1, bottom - top)), 0)
+    ImageDraw.Draw(mask).text((-left, -top), character, font=font, fill=255, anchor="ls")
+    return left, top, mask, font.getlength(character)
+
+
+def get_text_length(text, size, bold=False):
+    return sum(get_glyph(size, bold, character)[3] for character in text)
+
+
+def draw_text(image, x, y, text, size, bold=False):
+    """
+    Draws `text` with its baseline at `y`, glyph by glyph from the cache. Returns the x after the text.
+    """
+    for character in text:
+        left, top, mask, advance = get_glyph(size, bold, character)
+        if not character.isspace():
+            image.paste(0, (round(x + left), round(y + top)), mask)
+        x += advance
+    return x
+
+
+def get_block_lines(markup):
+    """
+    Splits a block of <tspan>s into lines of (text, bold) runs
+    """
+    lines = []
+    for attributes, content in tspan_pattern.findall(markup):
+        cdata = cdata_pattern.search(content)
+        text = cdata.group(1) if cdata else html.unescape(re.sub(r"<[^>]+>", "", content))
+        if "dy=" in attributes or not lines:
+            lines.append([])
+        lines[-1].append((text, 'font-weight="bold"' in attributes))
+    return lines
+
+
+def draw_field(image, field, output_dict, scale, atlas):
+    if isinstance(field, IconField):
+        icon_name = output_dict.get(field.key, "")
+        icon = atlas.get_icon(field.slot, icon_name)
+        if icon is None:
+            if icon_name in get_icon_names():
+                # The icon is all white
+                return
+            raise NativeRenderError("No icon {}".format(icon_name))
+        x, y, mask = icon
+        image.paste(0, (x, y), mask)
+        return
+
+    size = round(field.font_size * scale)
+    if isinstance(field, TextBlock):
+        y = field.y * scale
+        for line in get_block_lines(output_dict.get(field.key, "")):
+            y += size
+            x = field.x * scale
+            for text, bold in line:
+                x = draw_text(image, x, y, text, size, bold)
+        return
+
+    text = html.unescape(output_dict.get(field.key, "")).strip()
+    x = field.x * scale
+    if field.anchor == "middle":
+        x -= get_text_length(text, size) / 2
+    draw_text(image, x, field.y * scale, text, size)
+
+
+def render_native(output_dict, template_svg_filename):
+    """
+    Draws a layout straight into a 1-bit image with PIL, from its descriptor in `template_layouts`.
+    Returns the image in portrait, like render_image() does.
+    """
+    waveshare_width, waveshare_height = get_screen_size()
+    size = (waveshare_height, waveshare_width)
+    scale = waveshare_height / template_width
+
+    with span("rasterize", backend="native"):
+        image = Image.new("1", size, 255)
+        atlas = get_atlas(template_svg_filename, size)
+        for field in template_layouts[os.path.basename(template_svg_filename)]:
+            draw_field(image, field, output_dict, scale, atlas)
+    logging.debug("render_native() - {}x{}".format(image.width, image.height))
+    return image
+
+
+def rasterize_output(output_dict, template_svg_filename):
+    """
+    Draws the layout natively, or returns None if it should be rendered from its SVG instead
+    """
+    if not is_native_layout(template_svg_filename):
+        return None
+    try:
+        image = render_native(output_dict, template_svg_filename)
+    except (NativeRenderError, OSError) as error:
+        logging.warning("rasterize_output() - {}, rendering the SVG instead".format(error))
+        return None
+    save_debug_output(image)
+    return image
+
+
+def get_parity_error(image, reference):
+    """
+    Returns the fraction of black pixels in either image that have no black pixel within one pixel in the other.
+    Anti-aliasing and dithering move edges by a pixel, so an exact comparison would never match.
+    """
+    image = image.convert("L")
+    reference = reference.convert("L")
+    if image.size != reference.size:
+        return 1.0
+
+    # Black is 0, so the minimum grows the black areas by a pixel
+    missing = ImageChops.subtract(reference.filter(ImageFilter.MinFilter(3)), image)
+    extra = ImageChops.subtract(image.filter(ImageFilter.MinFilter(3)), reference)
+    ink = image.histogram()[0] + reference.histogram()[0]
+    if not ink:
+        return 0.0
+    return (missing.histogram()[255] + extra.histogram()[255]) / ink
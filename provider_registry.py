@@ -0,0 +1,329 @@
+import importlib
+import logging
+import os
+import time
+from typing import NamedTuple
+
+# Third party providers are found through entry points in these groups, eg. in a package's pyproject.toml:
+#   [project.entry-points."waveshare_epaper_display.weather_providers"]
+#   myweather = "myweather.declaration:provider"
+# where `provider` is a ProviderSpec. Only the module holding the declaration is imported to look at it.
+entry_point_groups = {
+    "weather": "waveshare_epaper_display.weather_providers",
+    "alert": "waveshare_epaper_display.alert_providers",
+    "calendar": "waveshare_epaper_display.calendar_providers",
+}
+
+# kind -> the third party ProviderSpecs, looked up once
+entry_point_specs = {}
+
+
+class ProviderSpec(NamedTuple):
+    """
+    Declares a provider without importing it.
+    `arguments` are passed to the class in order. Upper case names are read from the environment,
+    lower case names are supplied by the caller, eg. location_lat or units.
+    The provider is picked when every environment variable in `enabled_by` is set.
+    """
+
+    name: str
+    label: str
+    module: str
+    class_name: str
+    arguments: tuple
+    enabled_by: tuple
+    defaults: dict = {}
+
+
+weather_providers = [
+    ProviderSpec(
+        "visualcrossing",
+        "Visual Crossing",
+        "weather_providers.visualcrossing",
+        "VisualCrossing",
+        ("VISUALCROSSING_APIKEY", "location_lat", "location_long", "units"),
+        ("VISUALCROSSING_APIKEY",),
+    ),
+    ProviderSpec(
+        "meteireann",
+        "Met Eireann",
+        "weather_providers.meteireann",
+        "MetEireann",
+        ("location_lat", "location_long", "units"),
+        ("WEATHER_MET_EIREANN",),
+    ),
+    ProviderSpec(
+        "weathergov",
+        "Weather.gov",
+        "weather_providers.weathergov",
+        "WeatherGov",
+        ("WEATHERGOV_SELF_IDENTIFICATION", "location_lat", "location_long", "units"),
+        ("WEATHERGOV_SELF_IDENTIFICATION",),
+    ),
+    ProviderSpec(
+        "metno",
+        "Met.no",
+        "weather_providers.metno",
+        "MetNo",
+        ("METNO_SELF_IDENTIFICATION", "location_lat", "location_long", "units"),
+        ("METNO_SELF_IDENTIFICATION",),
+    ),
+    ProviderSpec(
+        "accuweather",
+        "Accuweather",
+        "weather_providers.accuweather",
+        "AccuWeather",
+        ("ACCUWEATHER_APIKEY", "location_lat", "location_long", "ACCUWEATHER_LOCATIONKEY", "units"),
+        ("ACCUWEATHER_APIKEY",),
+    ),
+    ProviderSpec(
+        "metoffice",
+        "Met Office Weather Datahub",
+        "weather_providers.metofficedatahub",
+        "MetOffice",
+        (
+            "METOFFICEDATAHUB_CLIENT_ID",
+            "METOFFICEDATAHUB_CLIENT_SECRET",
+            "location_lat",
+            "location_long",
+            "units",
+        ),
+        ("METOFFICEDATAHUB_CLIENT_ID",),
+    ),
+    ProviderSpec(
+        "openweathermap",
+        "OpenWeatherMap",
+        "weather_providers.openweathermap",
+        "OpenWeatherMap",
+        ("OPENWEATHERMAP_APIKEY", "location_lat", "location_long", "units"),
+        ("OPENWEATHERMAP_APIKEY",),
+    ),
+    ProviderSpec(
+        "climacell",
+        "Climacell",
+        "weather_providers.climacell",
+        "Climacell",
+        ("CLIMACELL_APIKEY", "location_lat", "location_long", "units"),
+        ("CLIMACELL_APIKEY",),
+    ),
+    ProviderSpec(
+        "smhi",
+        "SMHI",
+        "weather_providers.smhi",
+        "SMHI",
+        ("SMHI_SELF_IDENTIFICATION", "location_lat", "location_long", "units"),
+        ("SMHI_SELF_IDENTIFICATION",),
+    ),
+]
+
+alert_providers = [
+    ProviderSpec(
+        "weathergov",
+        "Weather.gov API",
+        "alert_providers.weathergovalerts",
+        "WeatherGovAlerts",
+        ("location_lat", "location_long", "ALERT_WEATHERGOV_SELF_IDENTIFICATION"),
+        ("ALERT_WEATHERGOV_SELF_IDENTIFICATION",),
+    ),
+    ProviderSpec(
+        "metoffice",
+        "Met Office RSS Feed",
+        "alert_providers.metofficerssfeed",
+        "MetOfficeRssFeed",
+        ("ALERT_METOFFICE_FEED_URL",),
+        ("ALERT_METOFFICE_FEED_URL",),
+    ),
+    ProviderSpec(
+        "meteireann",
+        "Met Eireann",
+        "alert_providers.meteireann",
+        "MetEireannAlertProvider",
+        ("ALERT_MET_EIREANN_FEED_URL",),
+        ("ALERT_MET_EIREANN_FEED_URL",),
+    ),
+]
+
+calendar_providers = [
+    ProviderSpec(
+        "outlook",
+        "Outlook Calendar",
+        "calendar_providers.outlook",
+        "OutlookCalendar",
+        ("OUTLOOK_CALENDAR_ID", "max_event_results", "from_date", "to_date"),
+        ("OUTLOOK_CALENDAR_ID",),
+    ),
+    ProviderSpec(
+        "caldav",
+        "Caldav Calendar",
+        "calendar_providers.caldav",
+        "CalDavCalendar",
+        (
+            "CALDAV_CALENDAR_URL",
+            "CALDAV_CALENDAR_ID",
+            "max_event_results",
+            "from_date",
+            "to_date",
+            "CALDAV_USERNAME",
+            "CALDAV_PASSWORD",
+        ),
+        ("CALDAV_CALENDAR_URL",),
+    ),
+    ProviderSpec(
+        "ics",
+        "ics Calendar",
+        "calendar_providers.ics",
+        "ICSCalendar",
+        ("ICS_CALENDAR_URL", "max_event_results", "from_date", "to_date"),
+        ("ICS_CALENDAR_URL",),
+    ),
+    # Google is the default, so it needs nothing to be set
+    ProviderSpec(
+        "google",
+        "Google Calendar",
+        "calendar_providers.google",
+        "GoogleCalendar",
+        ("GOOGLE_CALENDAR_ID", "max_event_results", "from_date", "to_date"),
+        (),
+        {"GOOGLE_CALENDAR_ID": "primary"},
+    ),
+]
+
+builtin_providers = {
+    "weather": weather_providers,
+    "alert": alert_providers,
+    "calendar": calendar_providers,
+}
+
+
+def get_entry_point_specs(kind):
+    """
+    Returns the ProviderSpecs that installed packages declare for `kind`.
+    importlib.metadata is only imported when a built-in provider isn't used.
+    """
+    if kind in entry_point_specs:
+        return entry_point_specs[kind]
+
+    from importlib.metadata import entry_points
+
+    group = entry_point_groups[kind]
+    found = entry_points()
+    # Python 3.10 can select by group, older versions return a dict of groups
+    found = found.select(group=group) if hasattr(found, "select") else found.get(group, [])
+
+    specs = []
+    for entry_point in found:
+        try:
+            spec = entry_point.load()
+        except Exception as error:
+            logging.warning("Unable to load the {} provider {}: {}".format(kind, entry_point.name, error))
+            continue
+        if not isinstance(spec, ProviderSpec):
+            logging.warning("{} doesn't declare a ProviderSpec, skipping it".format(entry_point.value))
+            continue
+        specs.append(spec)
+    entry_point_specs[kind] = specs
+    return specs
+
+
+def get_config(spec):
+    return {key: os.getenv(key, spec.defaults.get(key)) for key in spec.arguments if key.isupper()}
+
+
+def is_configured(spec):
+    return all(os.getenv(key, spec.defaults.get(key)) for key in spec.enabled_by)
+
+
+def get_instance_spec(spec, instance):
+    """
+    Returns the ProviderSpec for another instance of a provider, which reads its environment variables with the
+    instance's suffix, eg. "ics:2" reads ICS_CALENDAR_URL_2
+    """
+    def rename(key):
+        return "{}_{}".format(key, instance.upper()) if key.isupper() else key
+
+    return spec._replace(
+        name="{}:{}".format(spec.name, instance),
+        label="{} ({})".format(spec.label, instance),
+        arguments=tuple(rename(key) for key in spec.arguments),
+        enabled_by=tuple(rename(key) for key in spec.enabled_by),
+        defaults={rename(key): value for key, value in spec.defaults.items()},
+    )
+
+
+def find_provider_spec(kind, name):
+    """
+    Returns the built-in or third party ProviderSpec called `name`, or None if there isn't one.
+    A name like "ics:2" is another instance of the "ics" provider, see get_instance_spec().
+    """
+    name, _, instance = name.partition(":")
+    found = next((spec for spec in builtin_providers[kind] if spec.name == name), None)
+    if found is None:
+        found = next((spec for spec in get_entry_point_specs(kind) if spec.name == name), None)
+    if found:
+        return get_instance_spec(found, instance) if instance else found
+    logging.error("There is no {} provider called {}".format(kind, name))
+    return None
+
+
+def select_provider_spec(kind):
+    """
+    Returns the ProviderSpec to use for `kind`, or None if none is configured.
+    WEATHER_PROVIDER, ALERT_PROVIDER or CALENDAR_PROVIDER picks one by name,
+    otherwise the first configured built-in provider is picked, then the first configured third party provider.
+    """
+    chosen_name = os.getenv("{}_PROVIDER".format(kind.upper()))
+    if chosen_name:
+        return find_provider_spec(kind, chosen_name)
+
+    for spec in builtin_providers[kind]:
+        if is_configured(spec):
+            return spec
+    for spec in get_entry_point_specs(kind):
+        if is_configured(spec):
+            return spec
+    return None
+
+
+def select_provider_specs(kind):
+    """
+    Returns the ProviderSpecs to try for `kind`, in order.
+    WEATHER_PROVIDERS, for example, lists them by name, eg. "visualcrossing,metno,openweathermap".
+    Otherwise it's the one picked by WEATHER_PROVIDER, or every configured provider in priority order.
+    """
+    chosen_names = os.getenv("{}_PROVIDERS".format(kind.upper()))
+    if chosen_names:
+        specs = [find_provider_spec(kind, name.strip()) for name in chosen_names.split(",") if name.strip()]
+        return [spec for spec in specs if spec is not None]
+
+    if os.getenv("{}_PROVIDER".format(kind.upper())):
+        spec = select_provider_spec(kind)
+        return [spec] if spec else []
+
+    specs = [spec for spec in builtin_providers[kind] if is_configured(spec)]
+    return specs or [spec for spec in get_entry_point_specs(kind) if is_configured(spec)]
+
+
+def create_provider(spec, **context):
+    """
+    Imports the provider's module and creates it, with its environment config and the caller's `context`
+    """
+    import_start = time.monotonic()
+    provider_class = getattr(importlib.import_module(spec.module), spec.class_name)
+    logging.debug(
+        "create_provider() - Imported {} in {:.2f}s".format(spec.module, time.monotonic() - import_start)
+    )
+
+    config = get_config(spec)
+    arguments = [context[name] if name in context else config[name] for name in spec.arguments]
+    return provider_class(*arguments)
+
+
+def get_provider(kind, **context):
+    """
+    Returns a new provider of `kind` ("weather", "alert" or "calendar"), or None if none is configured
+    """
+    spec = select_provider_spec(kind)
+    if spec is None:
+        return None
+    logging.info("Getting {} from {}".format(kind, spec.label))
+    return create_provider(spec, **context)
@@ -0,0 +1,69 @@
+import os
+import logging
+import cairosvg
+from PIL import Image
+from spans import span
+
+waveshare_epd75_version = os.getenv("WAVESHARE_EPD75_VERSION", "2")
+
+# Set to 1 to also write the rendered image to screen-output.png, for debugging
+write_debug_output = os.getenv("WRITE_DEBUG_OUTPUT", "0") == "1"
+
+
+def get_screen_size():
+    """
+    Returns the (width, height) of the panel in landscape
+    """
+    if waveshare_epd75_version == "1":
+        return 640, 384
+    return 800, 480
+
+
+def render_image(svg, base_url):
+    """
+    Renders an SVG string with CairoSVG, in-process, at the screen's size.
+    `base_url` is used to resolve relative references such as icons/ and the custom SVG.
+    Returns a 1-bit PIL image in portrait, the way the templates are drawn.
+    """
+    waveshare_width, waveshare_height = get_screen_size()
+
+    with span("rasterize"):
+        tree = cairosvg.parser.Tree(bytestring=svg.encode("utf-8"), url=base_url)
+        # Drawing happens when the surface is created; it's never finished, so no PNG is encoded
+        surface = cairosvg.surface.PNGSurface(
+            tree,
+            None,
+            300,
+            output_width=waveshare_height,
+            output_height=waveshare_width,
+        )
+        surface.cairo.flush()
+
+        image = Image.frombuffer(
+            "RGBA",
+            (surface.cairo.get_width(), surface.cairo.get_height()),
+            surface.cairo.get_data(),
+            "raw",
+            "BGRA",
+            surface.cairo.get_stride(),
+            1,
+        ).convert("1")
+    logging.debug("render_image() - {}x{}".format(image.width, image.height))
+    return image
+
+
+def save_debug_output(image):
+    if write_debug_output:
+        logging.debug("save_debug_output() - Write to screen-output.png")
+        image.save("screen-output.png")
+
+
+def rasterize_svg(svg, base_url="screen-output-weather.svg"):
+    """
+    Renders an SVG string with CairoSVG, in-process.
+    `base_url` is used to resolve relative references such as icons/ and the custom SVG.
+    Returns a 1-bit PIL image in portrait, the way the templates are drawn.
+    """
+    image = render_image(svg, base_url)
+    save_debug_output(image)
+    return image
@@ -7,34 +7,12 @@ log() {
     echo "---------------------------------------"
 }
 
-log "Add Calendar info"
-.venv/bin/python3 screen-calendar-get.py
-
-log "Add weather info"
-.venv/bin/python3 screen-weather-get.py
-
-
-if [ -f screen-custom-get.py ]; then
-    log "Add Custom data"
-    .venv/bin/python3 screen-custom-get.py
-elif [ ! -f screen-output-custom-temp.svg ]; then
-    # Create temporary empty svg since the main SVG needs it
-    echo "<svg />" > screen-output-custom-temp.svg
-fi
-
-
-log "Export to PNG"
-
-if [ "$WAVESHARE_EPD75_VERSION" = 1 ]; then
-    WAVESHARE_WIDTH=640
-    WAVESHARE_HEIGHT=384
-else
-    WAVESHARE_WIDTH=800
-    WAVESHARE_HEIGHT=480
+if [ "$1" = "--daemon" ]; then
+    log "Start render daemon"
+    exec .venv/bin/python3 daemon.py
 fi
 
-# .venv/bin/cairosvg -o screen-output.png -f png --dpi 300 --output-width $WAVESHARE_WIDTH --output-height $WAVESHARE_HEIGHT screen-output-weather.svg
-.venv/bin/cairosvg -o screen-output.png -f png --dpi 300 --output-width $WAVESHARE_HEIGHT --output-height $WAVESHARE_WIDTH screen-output-weather.svg
-
-log "Display on epaper"
-.venv/bin/python3 display.py screen-output.png
+log "Render calendar, weather and custom data, and display on epaper"
+# Each stage adds its values to one output dict, and the template is rendered once, or drawn natively,
+# then handed straight to the display driver in the same process
+.venv/bin/python3 compose.py
@@ -2,15 +2,13 @@ import datetime
 import os.path
 import os
 import logging
+import typing
 from calendar_providers.base_provider import CalendarEvent
-from calendar_providers.caldav import CalDavCalendar
-from calendar_providers.google import GoogleCalendar
-from calendar_providers.ics import ICSCalendar
-from calendar_providers.outlook import OutlookCalendar
+import provider_registry
+from spans import span
 from utility import (
     get_formatted_day,
     get_formatted_time,
-    update_svg,
     configure_logging,
     get_formatted_date,
     configure_locale,
@@ -22,32 +20,37 @@ from utility import (
 configure_locale()
 configure_logging()
 
-# note: increasing this will require updates to the SVG template to accommodate more events
-max_event_results = 15
+# How many events to fetch. The calendar shows at most CALENDAR_DAY_MAX_EVENTS of them per day.
+max_event_results = int(os.getenv("CALENDAR_MAX_EVENTS", 15))
 
-google_calendar_id = os.getenv("GOOGLE_CALENDAR_ID", "primary")
-outlook_calendar_id = os.getenv("OUTLOOK_CALENDAR_ID", None)
+# How many days, starting today, the calendar shows
+calendar_days = int(os.getenv("CALENDAR_DAYS", 6))
 
-caldav_calendar_url = os.getenv("CALDAV_CALENDAR_URL", None)
-caldav_username = os.getenv("CALDAV_USERNAME", None)
-caldav_password = os.getenv("CALDAV_PASSWORD", None)
-caldav_calendar_id = os.getenv("CALDAV_CALENDAR_ID", None)
-
-ics_calendar_url = os.getenv("ICS_CALENDAR_URL", None)
+# The most lines of events to show under each day. When a day has more, the last line is "+N more". 0 shows them all.
+calendar_day_max_events = int(os.getenv("CALENDAR_DAY_MAX_EVENTS", 0))
 
 ttl = float(os.getenv("CALENDAR_TTL", 1 * 60 * 60))
 
 
-def get_day_svg(day: datetime.date, index: int) -> str:
+def get_day_svg(day: datetime.date, index: int, weather_dict: dict) -> str:
+    # Days without a forecast only show the date
+    weather_key = "WEATHER_TEMP_" + str(index)
+    if weather_key not in weather_dict:
+        return (
+            '<tspan x="0" dy="1em" font-weight="bold">'
+            + get_formatted_day(day)
+            + "</tspan>"
+        )
+
     return (
         '<tspan x="0" dy="1em" font-weight="bold">'
         + get_formatted_day(day)
         + "</tspan>"
         + "<tspan>"
-        + " (WEATHER_TEMP_"
-        + str(index)
-        + " WEATHER_DESC_"
-        + str(index)
+        + " ("
+        + weather_dict[weather_key]
+        + " "
+        + weather_dict.get("WEATHER_DESC_" + str(index), "")
         + ")"
         + "</tspan>"
     )
@@ -73,16 +76,106 @@ def get_event_svg(event: CalendarEvent) -> str:
     )
 
 
-def get_formatted_calendar_events(fetched_events: list[CalendarEvent]) -> str:
+def get_more_svg(count: int) -> str:
+    return '<tspan x="0" dy="1em"><![CDATA[+' + str(count) + " more]]></tspan>"
+
+
+def get_event_date(value) -> datetime.date:
+    return value.date() if isinstance(value, datetime.datetime) else value
+
+
+def get_events_by_day(
+    fetched_events: list[CalendarEvent], first_day: datetime.date, days: int
+) -> list[list[CalendarEvent]]:
+    """
+    Returns the events on each of `days` days from `first_day`, in start order.
+    An event is on every day from its start date to its end date.
+    The events are sorted once and swept through the days, rather than every event being checked for every day.
+    """
+    last_day = first_day + datetime.timedelta(days=days - 1)
+    spans = sorted(
+        (
+            (get_event_date(event.start), get_event_date(event.end), event)
+            for event in fetched_events
+        ),
+        key=lambda span: span[0],
+    )
+
+    buckets = []
+    # Events that have started and not yet ended, in start order
+    active = []
+    next_index = 0
+    day = first_day
+    while day <= last_day:
+        while next_index < len(spans) and spans[next_index][0] <= day:
+            active.append(spans[next_index])
+            next_index += 1
+        active = [span for span in active if span[1] >= day]
+        buckets.append([event for _, _, event in active])
+        day = day + datetime.timedelta(days=1)
+    return buckets
+
+
+def get_shown_events(day_events: list[CalendarEvent], shown: set) -> list[CalendarEvent]:
+    """
+    Returns the events a day shows, and adds them to `shown`, the ids of the events shown on the days before it.
+    A day with more than CALENDAR_DAY_MAX_EVENTS events keeps its last line for "+N more",
+    and no more than max_event_results different events are shown in all.
+    """
+    limit = len(day_events)
+    if calendar_day_max_events and len(day_events) > calendar_day_max_events:
+        limit = calendar_day_max_events - 1
+
+    shown_events = []
+    for event in day_events[:limit]:
+        if id(event) not in shown and len(shown) >= max_event_results:
+            break
+        shown.add(id(event))
+        shown_events.append(event)
+    return shown_events
+
+
+def take_calendar_events(
+    events: typing.Iterable[CalendarEvent], first_day: datetime.date, days: int
+) -> list[CalendarEvent]:
+    """
+    Reads events, in start order, from a provider's stream until an event starts after the last day,
+    or, without CALENDAR_DAY_MAX_EVENTS, max_event_results events have been read.
+    With CALENDAR_DAY_MAX_EVENTS, every event up to the last day is read, so that each day's "+N more" counts
+    all of its events, including the days past max_event_results; get_shown_events() picks the ones shown.
+    The rest are never fetched or expanded.
+    """
+    last_day = first_day + datetime.timedelta(days=days - 1)
+    taken = []
+    for event in events:
+        if get_event_date(event.start) > last_day:
+            break
+        taken.append(event)
+        if not calendar_day_max_events and len(taken) == max_event_results:
+            break
+    return taken
+
+
+def get_formatted_calendar_events(
+    fetched_events: list[CalendarEvent], weather_dict: dict
+) -> str:
+    """
+    Formats the events under a heading for each of the CALENDAR_DAYS days.
+    The headings show the forecast for that day from the `weather_dict` fragment.
+    Days with more than CALENDAR_DAY_MAX_EVENTS events, or events past max_event_results, end with a "+N more" line.
+    """
     tspans = []
     day = datetime.date.today()
+    shown = set()
 
-    for index in range(6):  # 6 days
-        tspans.append(get_day_svg(day, index))
+    for index, day_events in enumerate(get_events_by_day(fetched_events, day, calendar_days)):
+        tspans.append(get_day_svg(day, index, weather_dict))
 
-        for event in fetched_events:
-            if event.start.date() <= day <= event.end.date():
-                tspans.append(get_event_svg(event))
+        shown_events = get_shown_events(day_events, shown)
+        for event in shown_events:
+            tspans.append(get_event_svg(event))
+        if len(shown_events) < len(day_events):
+            tspans.append(get_more_svg(len(day_events) - len(shown_events)))
 
         day = day + datetime.timedelta(days=1)
         tspans.append(get_empty_svg())
@@ -169,64 +262,80 @@ def get_time_formatted(event_start, event_end, is_all_day_event):
     return day
 
 
-def main():
-    output_svg_filename = "screen-output-weather.svg"
-
+def get_calendar_date_range():
+    """
+    Returns the (from, to) window to query calendar providers with.
+    `from` is a naive UTC datetime. `to` is the end of the last of the CALENDAR_DAYS days shown, in local time;
+    nothing after that is shown, so providers needn't fetch or expand recurrences past it.
+    """
     today_start_time = datetime.datetime.utcnow()
     if os.getenv("CALENDAR_INCLUDE_PAST_EVENTS_FOR_TODAY", "0") == "1":
         today_start_time = datetime.datetime.combine(
             datetime.datetime.utcnow(), datetime.datetime.min.time()
         )
-    oneyearlater_iso = (
-        datetime.datetime.now().astimezone() + datetime.timedelta(days=365)
+    horizon_end = datetime.datetime.combine(
+        datetime.date.today() + datetime.timedelta(days=calendar_days), datetime.time.min
     ).astimezone()
+    return today_start_time, horizon_end
+
+
+def get_calendar_provider(today_start_time, horizon_end):
+    """
+    Returns the configured calendar provider, Google by default. Only that provider's module is imported.
+    When CALENDAR_PROVIDERS lists more than one, eg. "google,ics,ics:2", their events are shown together.
+    """
+    if os.getenv("CALENDAR_PROVIDERS"):
+        from calendar_providers.aggregate import CalendarAggregate
+
+        specs = provider_registry.select_provider_specs("calendar")
+        logging.info("Getting calendar from {}".format(", ".join(spec.label for spec in specs)))
+        return CalendarAggregate(specs, max_event_results, today_start_time, horizon_end)
+
+    return provider_registry.get_provider(
+        "calendar",
+        max_event_results=max_event_results,
+        from_date=today_start_time,
+        to_date=horizon_end,
+    )
 
-    if outlook_calendar_id:
-        logging.info("Fetching Outlook Calendar Events")
-        provider = OutlookCalendar(
-            outlook_calendar_id, max_event_results, today_start_time, oneyearlater_iso
-        )
-    elif caldav_calendar_url:
-        logging.info("Fetching Caldav Calendar Events")
-        provider = CalDavCalendar(
-            caldav_calendar_url,
-            caldav_calendar_id,
-            max_event_results,
-            today_start_time,
-            oneyearlater_iso,
-            caldav_username,
-            caldav_password,
-        )
-    elif ics_calendar_url:
-        logging.info("Fetching ics Calendar Events")
-        provider = ICSCalendar(
-            ics_calendar_url, max_event_results, today_start_time, oneyearlater_iso
-        )
+
+def get_calendar_events(provider=None) -> list[CalendarEvent]:
+    """
+    Fetches the calendar events.
+    A long-lived `provider` can be passed in (see daemon.py); its date range is moved along to today.
+    """
+    today_start_time, horizon_end = get_calendar_date_range()
+
+    if provider is None:
+        provider = get_calendar_provider(today_start_time, horizon_end)
     else:
-        logging.info("Fetching Google Calendar Events")
-        provider = GoogleCalendar(
-            google_calendar_id, max_event_results, today_start_time, oneyearlater_iso
-        )
+        provider.from_date = today_start_time
+        provider.to_date = horizon_end
 
-    calendar_events = provider.get_calendar_events()
+    with span("provider.calendar", provider=type(provider).__name__):
+        return take_calendar_events(provider.iter_calendar_events(), datetime.date.today(), calendar_days)
 
-    formatted_events = get_formatted_calendar_events(calendar_events)
+
+def get_calendar_output(calendar_events: list[CalendarEvent], weather_dict: dict) -> dict:
+    """
+    Returns the calendar fragment of the output dict.
+    """
+    formatted_events = get_formatted_calendar_events(calendar_events, weather_dict)
 
     output_dict = {
         "CAL_EVENTS": formatted_events,
     }
     # output_dict.update(get_calendar_days())
-    # output_dict.update()
 
-    logging.info("main() - {}".format(output_dict))
+    logging.info("get_calendar_output() - {}".format(output_dict))
+    return output_dict
 
-    logging.info("Updating SVG")
 
-    template_name = os.getenv("SCREEN_LAYOUT", "1")
-    template_svg_filename = f"screen-template.{template_name}.svg"
-    output_svg_filename = "screen-output-weather.svg"
-    update_svg(template_svg_filename, output_svg_filename, output_dict)
-    # update_svg(output_svg_filename, output_svg_filename, output_dict)
+def main():
+    """
+    Logs the calendar fragment. The SVG itself is rendered by compose.py.
+    """
+    return get_calendar_output(get_calendar_events(), {})
 
 
 if __name__ == "__main__":
@@ -1,23 +1,11 @@
 #!/usr/bin/python
 
 import datetime
-import sys
 import os
 import logging
-from weather_providers import (
-    climacell,
-    openweathermap,
-    metofficedatahub,
-    metno,
-    meteireann,
-    accuweather,
-    visualcrossing,
-    weathergov,
-    smhi,
-)
-from alert_providers import metofficerssfeed, weathergovalerts
-from alert_providers import meteireann as meteireannalertprovider
-from utility import get_formatted_time, update_svg, configure_logging, configure_locale
+import provider_registry
+from spans import span
+from utility import get_formatted_time, get_data_fetched_at, configure_logging, configure_locale
 import textwrap
 import html
 
@@ -40,95 +28,38 @@ def format_weather_description(weather_description):
     return weather_dict
 
 
-def get_weather(location_lat, location_long, units):
-    # gather relevant environment configs
-    climacell_apikey = os.getenv("CLIMACELL_APIKEY")
-    openweathermap_apikey = os.getenv("OPENWEATHERMAP_APIKEY")
-    metoffice_clientid = os.getenv("METOFFICEDATAHUB_CLIENT_ID")
-    metoffice_clientsecret = os.getenv("METOFFICEDATAHUB_CLIENT_SECRET")
-    accuweather_apikey = os.getenv("ACCUWEATHER_APIKEY")
-    accuweather_locationkey = os.getenv("ACCUWEATHER_LOCATIONKEY")
-    metno_self_id = os.getenv("METNO_SELF_IDENTIFICATION")
-    visualcrossing_apikey = os.getenv("VISUALCROSSING_APIKEY")
-    use_met_eireann = os.getenv("WEATHER_MET_EIREANN")
-    weathergov_self_id = os.getenv("WEATHERGOV_SELF_IDENTIFICATION")
-    smhi_self_id = os.getenv("SMHI_SELF_IDENTIFICATION")
-
-    if (
-        not climacell_apikey
-        and not openweathermap_apikey
-        and not metoffice_clientid
-        and not accuweather_apikey
-        and not metno_self_id
-        and not visualcrossing_apikey
-        and not use_met_eireann
-        and not weathergov_self_id
-        and not smhi_self_id
-    ):
+def get_weather_provider(location_lat, location_long, units):
+    """
+    Returns the configured weather provider. Only that provider's module is imported.
+    When more than one is configured, or WEATHER_PROVIDERS lists them, they're tried in order as a fallback chain.
+    Returns None if none is configured, so the screen is drawn without the weather.
+    """
+    specs = provider_registry.select_provider_specs("weather")
+    if not specs:
         logging.error(
             "No weather provider has been configured (Climacell, OpenWeatherMap, Weather.gov, MetOffice, AccuWeather, Met.no, Met Eireann, VisualCrossing...)"
         )
-        sys.exit(1)
+        return None
 
-    if visualcrossing_apikey:
-        logging.info("Getting weather from Visual Crossing")
-        weather_provider = visualcrossing.VisualCrossing(
-            visualcrossing_apikey, location_lat, location_long, units
-        )
+    context = {"location_lat": location_lat, "location_long": location_long, "units": units}
+    if len(specs) == 1:
+        logging.info("Getting weather from {}".format(specs[0].label))
+        return provider_registry.create_provider(specs[0], **context)
 
-    elif use_met_eireann:
-        logging.info("Getting weather from Met Eireann")
-        weather_provider = meteireann.MetEireann(location_lat, location_long, units)
+    from weather_providers.fallback import WeatherProviderChain
 
-    elif weathergov_self_id:
-        logging.info("Getting weather from Weather.gov")
-        weather_provider = weathergov.WeatherGov(
-            weathergov_self_id, location_lat, location_long, units
-        )
+    logging.info("Getting weather from {}".format(", then ".join(spec.label for spec in specs)))
+    return WeatherProviderChain(specs, **context)
 
-    elif metno_self_id:
-        logging.info("Getting weather from Met.no")
-        weather_provider = metno.MetNo(
-            metno_self_id, location_lat, location_long, units
-        )
 
-    elif accuweather_apikey:
-        logging.info("Getting weather from Accuweather")
-        weather_provider = accuweather.AccuWeather(
-            accuweather_apikey,
-            location_lat,
-            location_long,
-            accuweather_locationkey,
-            units,
-        )
+def get_weather(location_lat, location_long, units, weather_provider=None):
+    if weather_provider is None:
+        weather_provider = get_weather_provider(location_lat, location_long, units)
+    if weather_provider is None:
+        return None
 
-    elif metoffice_clientid:
-        logging.info("Getting weather from Met Office Weather Datahub")
-        weather_provider = metofficedatahub.MetOffice(
-            metoffice_clientid,
-            metoffice_clientsecret,
-            location_lat,
-            location_long,
-            units,
-        )
-
-    elif openweathermap_apikey:
-        logging.info("Getting weather from OpenWeatherMap")
-        weather_provider = openweathermap.OpenWeatherMap(
-            openweathermap_apikey, location_lat, location_long, units
-        )
-
-    elif climacell_apikey:
-        logging.info("Getting weather from Climacell")
-        weather_provider = climacell.Climacell(
-            climacell_apikey, location_lat, location_long, units
-        )
-
-    elif smhi_self_id:
-        logging.info("Getting weather from SMHI")
-        weather_provider = smhi.SMHI(smhi_self_id, location_lat, location_long, units)
-
-    weather = weather_provider.get_weather()
+    with span("provider.weather", provider=type(weather_provider).__name__):
+        weather = weather_provider.get_weather()
     logging.info("weather - {}".format(weather))
     return weather
 
@@ -139,37 +70,18 @@ def format_alert_description(alert_message):
 
 def get_alert_message(location_lat, location_long):
     alert_message = ""
-    alert_metoffice_feed_url = os.getenv("ALERT_METOFFICE_FEED_URL")
-    alert_weathergov_self_id = os.getenv("ALERT_WEATHERGOV_SELF_IDENTIFICATION")
-    alert_meteireann_feed_url = os.getenv("ALERT_MET_EIREANN_FEED_URL")
-
-    if alert_weathergov_self_id:
-        logging.info("Getting weather alert from Weather.gov API")
-        alert_provider = weathergovalerts.WeatherGovAlerts(
-            location_lat, location_long, alert_weathergov_self_id
-        )
-        alert_message = alert_provider.get_alert()
-
-    elif alert_metoffice_feed_url:
-        logging.info("Getting weather alert from Met Office RSS Feed")
-        alert_provider = metofficerssfeed.MetOfficeRssFeed(alert_metoffice_feed_url)
-        alert_message = alert_provider.get_alert()
-
-    elif alert_meteireann_feed_url:
-        logging.info("Getting weather alert from Met Eireann")
-        alert_provider = meteireannalertprovider.MetEireannAlertProvider(
-            alert_meteireann_feed_url
-        )
-        alert_message = alert_provider.get_alert()
+    alert_provider = provider_registry.get_provider(
+        "alert", location_lat=location_lat, location_long=location_long
+    )
+    if alert_provider:
+        with span("provider.alert", provider=type(alert_provider).__name__):
+            alert_message = alert_provider.get_alert()
 
     logging.info("alert - {}".format(alert_message))
     return alert_message
 
 
-def main():
-    # template_name = os.getenv("SCREEN_LAYOUT", "1")
-    location_lat = os.getenv("WEATHER_LATITUDE", "51.5077")
-    location_long = os.getenv("WEATHER_LONGITUDE", "-0.1277")
+def get_units():
     weather_format = os.getenv("WEATHER_FORMAT", "CELSIUS")
 
     if weather_format == "CELSIUS":
@@ -178,15 +90,36 @@ def main():
     else:
         units = "imperial"
         degrees = "°F"
+    return units, degrees
 
-    weather = get_weather(location_lat, location_long, units)
+
+def get_location():
+    location_lat = os.getenv("WEATHER_LATITUDE", "51.5077")
+    location_long = os.getenv("WEATHER_LONGITUDE", "-0.1277")
+    return location_lat, location_long
+
+
+def get_weather_output(weather_provider=None):
+    """
+    Returns the weather fragment of the output dict, or None if there is no weather.
+    A long-lived `weather_provider` can be passed in (see daemon.py).
+    """
+    location_lat, location_long = get_location()
+    units, degrees = get_units()
+
+    if weather_provider is None:
+        weather_provider = get_weather_provider(location_lat, location_long, units)
+        if weather_provider is None:
+            return None
+
+    weather = get_weather(location_lat, location_long, units, weather_provider)
 
     if not weather:
-        logging.error("Unable to fetch weather payload. SVG will not be updated.")
-        return
+        logging.error("Unable to fetch weather payload. Weather will not be shown.")
+        return None
 
     weather_dict = {}
-    weather = list(weather) if type(weather) == dict else weather
+    weather = [weather] if type(weather) == dict else weather
 
     for i, w in enumerate(weather):
         logging.info(w)
@@ -201,44 +134,78 @@ def main():
         weather_dict["WEATHER_ICON_" + str(i)] = weather_icon
         weather_dict["WEATHER_DESC_" + str(i)] = weather_desc[1]
 
-    # alert_message = get_alert_message(location_lat, location_long)
-    # alert_message = format_alert_description(alert_message)
-
-    time_now = get_formatted_time(datetime.datetime.now())
-    # time_now_font_size = "40px"
-
-    # if len(time_now) > 6:
-    #     time_now_font_size = str(100 - (len(time_now)-5) * 5) + "px"
-
     output_dict = {
         # "LOW_ONE": "{}{}".format(str(round(weather["temperatureMin"])), degrees),
         # "HIGH_ONE": "{}{}".format(str(round(weather["temperatureMax"])), degrees),
         # "ICON_ONE": weather["icon"],
         # "WEATHER_DESC_1": weather_desc[1],
         # "WEATHER_DESC_2": weather_desc[2],
-        # "TIME_NOW_FONT_SIZE": time_now_font_size,
         "WEATHER_ICON_NOW": weather_dict["WEATHER_ICON_0"],
         "WEATHER_NOW": "{} {}".format(
             weather_dict["WEATHER_TEMP_0"], weather_dict["WEATHER_DESC_0"]
         ),
+        "WEATHER_UPDATED": get_weather_updated(weather_provider),
+    }
+    output_dict.update(weather_dict)
+
+    logging.info(output_dict)
+    return output_dict
+
+
+def get_weather_updated(weather_provider):
+    """
+    Returns the time the weather was fetched, so that layouts can show how old it is
+    """
+    # A fallback chain reports the provider that answered
+    weather_provider = getattr(weather_provider, "current_provider", None) or weather_provider
+    fetched_at = get_data_fetched_at(type(weather_provider).__name__)
+    if fetched_at is None:
+        return ""
+    return get_formatted_time(datetime.datetime.fromtimestamp(fetched_at))
+
+
+def get_alert_output():
+    """
+    Returns the severe weather alert fragment of the output dict.
+    """
+    location_lat, location_long = get_location()
+    alert_message = get_alert_message(location_lat, location_long)
+    alert_message = format_alert_description(alert_message)
+
+    return {
+        "ALERT_MESSAGE_VISIBILITY": "visible" if alert_message else "hidden",
+        "ALERT_MESSAGE": alert_message,
+    }
+
+
+def get_time_output():
+    """
+    Returns the date and time fragment of the output dict.
+    """
+    time_now = get_formatted_time(datetime.datetime.now())
+    # time_now_font_size = "40px"
+
+    # if len(time_now) > 6:
+    #     time_now_font_size = str(100 - (len(time_now)-5) * 5) + "px"
+
+    return {
+        # "TIME_NOW_FONT_SIZE": time_now_font_size,
         "TIME_NOW": time_now,
         "HOUR_NOW": datetime.datetime.now().strftime("%H:%M"),
         "DAY_ONE": datetime.datetime.now().strftime("%d.%m.%Y"),
         "DAY_NAME": datetime.datetime.now().strftime("%A"),
-        # "ALERT_MESSAGE_VISIBILITY": "visible" if alert_message else "hidden",
-        # "ALERT_MESSAGE": alert_message,
     }
-    output_dict.update(weather_dict)
 
-    logging.info(output_dict)
-
-    logging.info("Updating SVG")
 
-    # template_svg_filename = f"screen-template.{template_name}.svg"
-    # output_svg_filename = "screen-output-weather.svg"
-    # update_svg(template_svg_filename, output_svg_filename, output_dict)
-    output_svg_filename = "screen-output-weather.svg"
-    update_svg(output_svg_filename, output_svg_filename, output_dict)
+def main():
+    """
+    Logs the weather, alert and time fragments. The SVG itself is rendered by compose.py.
+    """
+    output_dict = get_weather_output() or {}
+    output_dict.update(get_alert_output())
+    output_dict.update(get_time_output())
+    logging.info("main() - {}".format(output_dict))
+    return output_dict
 
 
 if __name__ == "__main__":
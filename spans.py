@@ -0,0 +1,127 @@
+import contextlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+# Set to a filename to append a JSON line for every timed stage of a refresh, eg. spans.jsonl
+spans_filename = os.getenv("SPANS_FILE")
+
+# Set to a filename in node_exporter's textfile collector directory to export the timings to Prometheus,
+# eg. /var/lib/node_exporter/textfile_collector/epaper.prom
+metrics_filename = os.getenv("METRICS_TEXTFILE")
+
+# Spans from the same refresh share a cycle id. SPANS_CYCLE sets it, for scripts that run as part of a refresh.
+cycle_id = os.getenv("SPANS_CYCLE") or str(int(time.time()))
+
+# (span, outcome) -> [last duration, total duration, count], for the metrics file
+span_totals = {}
+span_lock = threading.Lock()
+
+metric_line_pattern = re.compile(r'^(\w+)\{span="([^"]*)",outcome="([^"]*)"\} (\S+)$')
+
+
+def start_cycle():
+    """
+    Starts a new cycle id, for the daemon, which runs many cycles in one process
+    """
+    global cycle_id
+    cycle_id = str(int(time.time()))
+
+
+def record_span(name, duration, **attributes):
+    """
+    Records that the stage `name` took `duration` seconds.
+    `attributes` describe it, eg. the provider, or whether it came from the cache with outcome="hit".
+    """
+    outcome = str(attributes.get("outcome", ""))
+    with span_lock:
+        totals = span_totals.setdefault((name, outcome), [0.0, 0.0, 0])
+        totals[0] = duration
+        totals[1] += duration
+        totals[2] += 1
+
+        if spans_filename:
+            line = {"cycle": cycle_id, "time": time.time() - duration, "span": name, "duration": round(duration, 6)}
+            line.update(attributes)
+            try:
+                with open(spans_filename, "a") as spans_file:
+                    spans_file.write(json.dumps(line, default=str) + "\n")
+            except OSError as error:
+                logging.warning("record_span() - {}".format(error))
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """
+    Times the block inside `with span(name):`.
+    The yielded dict is the span's attributes, so the block can add to them, eg. its outcome.
+    """
+    start = time.monotonic()
+    try:
+        yield attributes
+    except Exception:
+        attributes.setdefault("outcome", "error")
+        raise
+    finally:
+        record_span(name, time.monotonic() - start, **attributes)
+
+
+def read_metrics(filename):
+    """
+    Returns the totals in an existing metrics file, so that each script adds to them rather than replacing them
+    """
+    totals = {}
+    if not os.path.isfile(filename):
+        return totals
+    with open(filename, "r") as metrics_file:
+        for line in metrics_file:
+            match = metric_line_pattern.match(line.strip())
+            if not match:
+                continue
+            metric, name, outcome, value = match.groups()
+            index = {
+                "epaper_span_last_seconds": 0,
+                "epaper_span_seconds_total": 1,
+                "epaper_span_count_total": 2,
+            }.get(metric)
+            if index is not None:
+                totals.setdefault((name, outcome), [0.0, 0.0, 0])[index] = float(value)
+    return totals
+
+
+def write_metrics():
+    """
+    Writes the span timings in Prometheus' text format, if METRICS_TEXTFILE is set.
+    The file is replaced in one go, so the collector never reads half of it.
+    """
+    if not metrics_filename:
+        return
+
+    with span_lock:
+        totals = read_metrics(metrics_filename)
+        for key, (last, total, count) in span_totals.items():
+            previous = totals.get(key, [0.0, 0.0, 0])
+            totals[key] = [last, previous[1] + total, previous[2] + count]
+        span_totals.clear()
+
+    lines = []
+    for metric, index, metric_type, description in (
+        ("epaper_span_last_seconds", 0, "gauge", "How long the stage took the last time it ran"),
+        ("epaper_span_seconds_total", 1, "counter", "Total time spent in the stage"),
+        ("epaper_span_count_total", 2, "counter", "How many times the stage ran"),
+    ):
+        lines.append("# HELP {} {}".format(metric, description))
+        lines.append("# TYPE {} {}".format(metric, metric_type))
+        for (name, outcome), values in sorted(totals.items()):
+            lines.append('{}{{span="{}",outcome="{}"}} {}'.format(metric, name, outcome, values[index]))
+
+    temp_filename = metrics_filename + ".tmp"
+    try:
+        with open(temp_filename, "w") as metrics_file:
+            metrics_file.write("\n".join(lines) + "\n")
+        os.replace(temp_filename, metrics_filename)
+    except OSError as error:
+        logging.warning("write_metrics() - {}".format(error))
@@ -0,0 +1,85 @@
+import importlib.abc
+import sys
+import time
+
+# module name -> (total seconds, seconds excluding the modules it imported)
+import_times = {}
+
+# The time spent importing other modules, for each module that's being imported right now
+import_stack = []
+
+# The modules that were imported by the script itself, rather than by another module
+direct_imports = []
+
+
+class TimedLoader(importlib.abc.Loader):
+    """
+    Wraps a module's loader, to time how long the module takes to execute
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        import_stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = import_stack.pop()
+            if import_stack:
+                import_stack[-1] += elapsed
+            else:
+                direct_imports.append(module.__name__)
+            import_times[module.__name__] = (elapsed, elapsed - nested)
+
+
+class TimedFinder(importlib.abc.MetaPathFinder):
+    """
+    Finds modules with the other finders, and gives them a TimedLoader
+    """
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                    spec.loader = TimedLoader(spec.loader)
+                return spec
+        return None
+
+
+def enable():
+    """
+    Starts timing every import from here on
+    """
+    sys.meta_path.insert(0, TimedFinder())
+
+
+def report(total_time, limit=25):
+    """
+    Prints the slowest imports, and how much of the startup time they account for
+    """
+    print("Startup took {:.2f}s".format(total_time))
+    print("{:>9} {:>9}  {}".format("total", "self", "module"))
+    slowest = sorted(import_times.items(), key=lambda item: item[1][1], reverse=True)
+    for name, (elapsed, own) in slowest[:limit]:
+        print("{:>8.3f}s {:>8.3f}s  {}".format(elapsed, own, name))
+
+    print("Imported directly by the script:")
+    for name in sorted(direct_imports, key=lambda name: import_times[name][0], reverse=True):
+        print("{:>8.3f}s  {}".format(import_times[name][0], name))
+    print(
+        "{} modules imported in {:.2f}s".format(
+            len(import_times), sum(import_times[name][0] for name in direct_imports)
+        )
+    )
@@ -0,0 +1,64 @@
+import codecs
+import logging
+import os
+import re
+
+# Placeholders are upper case words joined by underscores, eg. CAL_EVENTS, WEATHER_TEMP_1 or CUSTOM_DATA_1.
+# Matching whole words means WEATHER_TEMP_1 never matches part of WEATHER_TEMP_10.
+placeholder_pattern = re.compile(r"\b([A-Z][A-Z0-9]*(?:_[A-Z0-9]+)+)\b")
+
+# template filename -> (mtime, size, SvgTemplate)
+template_cache = {}
+
+
+class SvgTemplate:
+    """
+    A template that has been split once into literal text and placeholder segments,
+    so that it can be rendered with any output dict in a single pass.
+    """
+
+    def __init__(self, text):
+        # Splitting on a capturing group puts the literals at even indexes and the placeholders at odd indexes
+        self.segments = placeholder_pattern.split(text)
+        self.placeholders = set(self.segments[1::2])
+
+    def render(self, output_dict):
+        """
+        Returns the template text with each placeholder replaced by its value in `output_dict`.
+        Placeholders without a value are left as they are.
+        Values are inserted as-is, they're never substituted again.
+        """
+        segments = self.segments.copy()
+        for index in range(1, len(segments), 2):
+            segments[index] = output_dict.get(segments[index], segments[index])
+        return "".join(segments)
+
+    def get_missing_placeholders(self, output_dict):
+        """
+        Returns the placeholders in the template that `output_dict` has no value for
+        """
+        return self.placeholders - output_dict.keys()
+
+    def get_unused_keys(self, output_dict):
+        """
+        Returns the keys in `output_dict` that don't appear in the template
+        """
+        return output_dict.keys() - self.placeholders
+
+
+def get_template(template_svg_filename):
+    """
+    Returns the compiled `SvgTemplate` for a file.
+    It's compiled once and cached until the file changes.
+    """
+    stat = os.stat(template_svg_filename)
+    cached = template_cache.get(template_svg_filename)
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        logging.debug("get_template({}) - Found in cache".format(template_svg_filename))
+        return cached[2]
+
+    logging.debug("get_template({}) - Compiling".format(template_svg_filename))
+    with codecs.open(template_svg_filename, "r", encoding="utf-8") as template_file:
+        template = SvgTemplate(template_file.read())
+    template_cache[template_svg_filename] = (stat.st_mtime_ns, stat.st_size, template)
+    return template
@@ -1,9 +1,12 @@
 import codecs
 import logging
 import os
+import threading
 import time
 from http.client import HTTPConnection
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import datetime
 import pytz
 import json
@@ -13,6 +16,53 @@ from astral.sun import sun
 import humanize
 import locale
 from babel.dates import format_time
+from svg_template import get_template
+from cache_store import get_cache_store, make_cache_key
+from spans import span
+
+
+# How long, in seconds, to wait for a server to respond
+http_timeout = float(os.getenv("HTTP_TIMEOUT", 30))
+# How many times to retry a request that failed to connect or got a server error
+http_retries = int(os.getenv("HTTP_RETRIES", 2))
+
+
+def create_http_session():
+    """
+    Creates a session whose connections are pooled and kept alive,
+    so that calls to the same host don't each pay for a new TCP and TLS handshake.
+    """
+    retry = Retry(
+        total=http_retries,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=8, pool_maxsize=8)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Shared by all the providers
+http_session = create_http_session()
+
+# Set to 1 to show stale cached data straight away, and fetch the fresh data in the background
+cache_stale_while_revalidate = os.getenv("CACHE_STALE_WHILE_REVALIDATE", "0") == "1"
+# The oldest, in seconds, that cached data may be shown while its source is slow or down
+cache_max_staleness = float(os.getenv("CACHE_MAX_STALENESS", 24 * 60 * 60))
+
+# cache name -> when the data last served for it was fetched, see get_data_fetched_at()
+data_fetched_at = {}
+
+# cache key -> ((ETag, Last-Modified, length of the body), parsed body), so that a body that's served again from the
+# cache, or revalidated with a 304, isn't parsed again. A 200 drops the entry, see fetch_into_cache().
+parsed_responses = {}
+
+# Cache keys being revalidated in the background
+revalidating_keys = set()
+revalidating_keys_lock = threading.Lock()
 
 
 def configure_locale():
@@ -47,99 +97,217 @@ def configure_logging():
     handler.setFormatter(formatter)
 
 
+def get_template_svg_filename():
+    """
+    Returns the template for the chosen SCREEN_LAYOUT
+    """
+    template_name = os.getenv("SCREEN_LAYOUT", "1")
+    return f"screen-template.{template_name}.svg"
+
+
+def render_svg(template_svg_filename, output_dict):
+    """
+    Renders the `template_svg_filename` SVG.
+    Replaces placeholder keys with values from `output_dict`, in a single pass
+    Returns the output SVG
+    """
+    template = get_template(template_svg_filename)
+
+    logging.debug(
+        "render_svg() - Missing placeholders: {}".format(
+            sorted(template.get_missing_placeholders(output_dict))
+        )
+    )
+    logging.debug(
+        "render_svg() - Unused keys: {}".format(
+            sorted(template.get_unused_keys(output_dict))
+        )
+    )
+    with span("substitute", template=template_svg_filename):
+        return template.render(output_dict)
+
+
 # utilize a template svg as a base for output of values
 def update_svg(template_svg_filename, output_svg_filename, output_dict):
     """
     Update the `template_svg_filename` SVG.
-    Replaces keys with values from `output_dict`
+    Replaces placeholder keys with values from `output_dict`, in a single pass
     Writes the output to `output_svg_filename`
+    Returns the output SVG
     """
-    # replace tags with values in SVG
-    output = codecs.open(template_svg_filename, "r", encoding="utf-8").read()
-
-    for output_key in output_dict:
-        logging.debug(
-            "update_svg() - {} -> {}".format(output_key, output_dict[output_key])
-        )
-        output = output.replace(output_key, output_dict[output_key])
+    output = render_svg(template_svg_filename, output_dict)
 
     logging.debug("update_svg() - Write to SVG {}".format(output_svg_filename))
 
     codecs.open(output_svg_filename, "w", encoding="utf-8").write(output)
+    return output
 
 
-def is_stale(filepath, ttl):
+def get_conditional_headers(cache_entry, headers):
     """
-    Checks if the specified `filepath` is older than the `ttl` in seconds
-    Returns true if the file doesn't exist.
+    Adds If-None-Match and If-Modified-Since to a copy of `headers`,
+    using the ETag and Last-Modified stored with the `cache_entry`.
     """
+    conditional_headers = dict(headers)
+    if cache_entry:
+        if cache_entry.etag:
+            conditional_headers["If-None-Match"] = cache_entry.etag
+        if cache_entry.last_modified:
+            conditional_headers["If-Modified-Since"] = cache_entry.last_modified
+    return conditional_headers
 
-    verdict = True
-    if os.path.isfile(filepath):
-        verdict = time.time() - os.path.getmtime(filepath) > ttl
 
-    logging.debug("is_stale({}) - {}".format(filepath, str(verdict)))
+def fetch_into_cache(url, headers, cache_key, cache_entry, ttl, span_attributes=None):
+    """
+    Perform a conditional HTTP GET for a `url` with optional `headers`, using the shared session.
+    Stores the response in the cache store under `cache_key` for `ttl` seconds.
+    Sets the outcome in `span_attributes` to "revalidated" or "network".
+    Returns the response body as text, and its ETag and Last-Modified.
+    """
+    if span_attributes is None:
+        span_attributes = {}
+    cache_store = get_cache_store()
+    response = http_session.get(
+        url,
+        headers=get_conditional_headers(cache_entry, headers),
+        timeout=http_timeout,
+    )
+
+    if response.status_code == 304 and cache_entry:
+        logging.info("Not modified. Refreshing the cache.")
+        span_attributes["outcome"] = "revalidated"
+        cache_store.touch(cache_key, ttl)
+        return cache_entry.value, cache_entry.etag, cache_entry.last_modified
+
+    span_attributes["outcome"] = "network"
+    parsed_responses.pop(cache_key, None)
+    if not response.ok:
+        logging.error(response.text)
+        logging.error(response.headers)
+    response.raise_for_status()
+
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    cache_store.set(cache_key, response.text, ttl, etag=etag, last_modified=last_modified)
+    return response.text, etag, last_modified
+
+
+def revalidate_in_background(url, headers, cache_key, cache_entry, ttl):
+    """
+    Refreshes a cache entry on another thread, unless it's already being refreshed.
+    The thread isn't a daemon, so a one-off run waits for it before exiting.
+    """
+    with revalidating_keys_lock:
+        if cache_key in revalidating_keys:
+            return
+        revalidating_keys.add(cache_key)
 
-    return verdict
+    def revalidate():
+        try:
+            with span("fetch.background", url=url) as attributes:
+                fetch_into_cache(url, headers, cache_key, cache_entry, ttl, attributes)
+        except Exception as error:
+            logging.error("Background refresh of {} failed - {}".format(url, error))
+        finally:
+            with revalidating_keys_lock:
+                revalidating_keys.discard(cache_key)
 
+    threading.Thread(target=revalidate).start()
 
-def get_json_from_url(url, headers, cache_file_name, ttl):
+
+def get_data_fetched_at(cache_name):
     """
-    Perform an HTTP GET for a `url` with optional `headers`.
-    Caches the response in `cache_file_name` for `ttl` seconds.
-    Returns the response as JSON
+    Returns when the data last served for `cache_name` was fetched, as a timestamp,
+    or None if nothing has been served for it yet.
     """
-    response_json = False
+    return data_fetched_at.get(cache_name)
+
 
-    if is_stale(cache_file_name, ttl):
-        logging.info("Cache file is stale. Fetching from source.")
+def fetch_text(url, headers, cache_name, ttl):
+    """
+    Does the work of get_text_from_url().
+    Returns the response body as text, its cache key, and its ETag and Last-Modified, which stay the same
+    while the same body is served from the cache or revalidated.
+    """
+    with span("fetch", provider=cache_name) as attributes:
+        cache_key = make_cache_key("http", cache_name, url, headers)
+        cache_entry = get_cache_store().get(cache_key)
+
+        if cache_entry and not cache_entry.is_stale():
+            logging.info("Found in cache.")
+            attributes["outcome"] = "hit"
+            data_fetched_at[cache_name] = cache_entry.stored_at
+            return cache_entry.value, cache_key, cache_entry.etag, cache_entry.last_modified
+
+        if cache_entry and cache_stale_while_revalidate and cache_entry.get_age() <= cache_max_staleness:
+            logging.info("Cache is stale. Using it while fetching from source in the background.")
+            attributes["outcome"] = "stale"
+            revalidate_in_background(url, headers, cache_key, cache_entry, ttl)
+            data_fetched_at[cache_name] = cache_entry.stored_at
+            return cache_entry.value, cache_key, cache_entry.etag, cache_entry.last_modified
+
+        logging.info("Cache is stale. Fetching from source.")
         try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            response_data = response.text
-            response_json = json.loads(response_data)
-            with open(cache_file_name, "w") as text_file:
-                json.dump(response_json, text_file, indent=4)
+            text, etag, last_modified = fetch_into_cache(url, headers, cache_key, cache_entry, ttl, attributes)
         except Exception as error:
             logging.error(error)
-            logging.error(response.text)
-            logging.error(response.headers)
+            if cache_entry and cache_entry.get_age() <= cache_max_staleness:
+                logging.warning("Using cached data from {:.0f} seconds ago.".format(cache_entry.get_age()))
+                attributes["outcome"] = "stale_on_error"
+                data_fetched_at[cache_name] = cache_entry.stored_at
+                return cache_entry.value, cache_key, cache_entry.etag, cache_entry.last_modified
             raise
-    else:
-        logging.info("Found in cache.")
-        with open(cache_file_name, "r") as file:
-            return json.loads(file.read())
-    return response_json
+
+        data_fetched_at[cache_name] = time.time()
+        return text, cache_key, etag, last_modified
+
+
+def get_text_from_url(url, headers, cache_name, ttl):
+    """
+    Perform a conditional HTTP GET for a `url` with optional `headers`, using the shared session.
+    Caches the response in the cache store for `ttl` seconds,
+    keyed by `cache_name` (usually the provider), the `url` and the `headers`.
+    If the source fails, cached data up to CACHE_MAX_STALENESS seconds old is returned instead.
+    Returns the response body as text.
+    """
+    return fetch_text(url, headers, cache_name, ttl)[0]
+
+
+def get_parsed_from_url(url, headers, cache_name, ttl, parse):
+    """
+    Returns the body of get_text_from_url(), parsed with `parse`.
+    The parsed body is kept in memory while the same body is served from the cache or revalidated with a 304,
+    so only a 200 with a new body is parsed again. Callers mustn't change it.
+    """
+    text, cache_key, etag, last_modified = fetch_text(url, headers, cache_name, ttl)
+    body_key = (etag, last_modified, len(text))
+    parsed_response = parsed_responses.get(cache_key)
+    if parsed_response and parsed_response[0] == body_key:
+        return parsed_response[1]
+
+    with span("parse", provider=cache_name):
+        parsed = parse(text)
+    parsed_responses[cache_key] = (body_key, parsed)
+    return parsed
 
 
-def get_xml_from_url(url, headers, cache_file_name, ttl):
+def get_json_from_url(url, headers, cache_name, ttl):
     """
     Perform an HTTP GET for a `url` with optional `headers`.
-    Caches the response in `cache_file_name` for `ttl` seconds.
-    Returns the response as an XML ElementTree object
+    Caches the response under `cache_name` for `ttl` seconds.
+    Returns the response as JSON
     """
-    logging.info(url)
+    return get_parsed_from_url(url, headers, cache_name, ttl, json.loads)
 
-    if is_stale(cache_file_name, ttl):
-        logging.info("Cache file is stale. Fetching from source.")
-        try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            response_data = response.text
 
-            with open(cache_file_name, "w") as text_file:
-                text_file.write(response_data)
-        except Exception as error:
-            logging.error(error)
-            logging.error(response.text)
-            logging.error(response.headers)
-            raise
-    else:
-        logging.info("Found in cache.")
-        with open(cache_file_name, "r") as file:
-            response_data = file.read()
-    response_xml = ET.fromstring(response_data)
-    return response_xml
+def get_xml_from_url(url, headers, cache_name, ttl):
+    """
+    Perform an HTTP GET for a `url` with optional `headers`.
+    Caches the response under `cache_name` for `ttl` seconds.
+    Returns the response as an XML ElementTree object
+    """
+    logging.info(url)
+    return get_parsed_from_url(url, headers, cache_name, ttl, ET.fromstring)
 
 
 def get_formatted_time(dt):
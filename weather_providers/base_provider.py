@@ -1,6 +1,6 @@
 import os
 from abc import ABC, abstractmethod
-from utility import get_xml_from_url, get_json_from_url
+from utility import get_xml_from_url, get_json_from_url, get_text_from_url
 import logging
 from astral import LocationInfo
 from astral.sun import sun
@@ -57,15 +57,23 @@ class BaseWeatherProvider(ABC):
     def get_response_json(self, url, headers={}):
         """
         Perform an HTTP GET for a `url` with optional `headers`.
-        Caches the response in `cache_file_name` for WEATHER_TTL seconds.
+        Caches the response for WEATHER_TTL seconds, keyed by the provider, URL and headers.
         Returns the response as JSON
         """
-        return get_json_from_url(url, headers, "cache_weather.json", self.ttl)
+        return get_json_from_url(url, headers, type(self).__name__, self.ttl)
 
     def get_response_xml(self, url, headers={}):
         """
         Perform an HTTP GET for a `url` with optional `headers`.
-        Caches the response in `cache_file_name` for WEATHER_TTL seconds.
+        Caches the response for WEATHER_TTL seconds, keyed by the provider, URL and headers.
         Returns the response as an XML ElementTree
         """
-        return get_xml_from_url(url, headers, "cache_weather.xml", self.ttl)
+        return get_xml_from_url(url, headers, type(self).__name__, self.ttl)
+
+    def get_response_text(self, url, headers={}):
+        """
+        Perform an HTTP GET for a `url` with optional `headers`.
+        Caches the response for WEATHER_TTL seconds, keyed by the provider, URL and headers.
+        Returns the response body as text, for providers that parse it as a stream
+        """
+        return get_text_from_url(url, headers, type(self).__name__, self.ttl)
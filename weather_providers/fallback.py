@@ -0,0 +1,113 @@
+import logging
+import os
+import queue
+import threading
+import time
+import provider_registry
+from circuit_breaker import CircuitBreaker
+from weather_providers.base_provider import BaseWeatherProvider
+
+# How long, in seconds, each provider has to answer before the next one is tried
+provider_budget = float(os.getenv("WEATHER_PROVIDER_BUDGET", 10))
+# Set to 1 to start the next provider when one goes over its budget, while still waiting for the slow one
+hedge_providers = os.getenv("WEATHER_PROVIDER_HEDGE", "0") == "1"
+# After this many failures in a row, a provider is skipped for WEATHER_PROVIDER_COOLDOWN seconds
+breaker_failure_threshold = int(os.getenv("WEATHER_PROVIDER_FAILURES", 3))
+breaker_cooldown = float(os.getenv("WEATHER_PROVIDER_COOLDOWN", 15 * 60))
+
+
+class WeatherProviderChain(BaseWeatherProvider):
+    """
+    Tries a list of weather providers in order, until one of them returns a forecast.
+    Each provider has a latency budget and a circuit breaker, so a slow or dead API doesn't hold up the screen.
+    The providers all return the same forecast shape, so any of them can stand in for another.
+    """
+
+    def __init__(self, specs, **context):
+        self.specs = specs
+        self.context = context
+        self.providers = {}
+        self.breakers = {
+            spec.name: CircuitBreaker("weather." + spec.name, breaker_failure_threshold, breaker_cooldown)
+            for spec in specs
+        }
+        # The provider that returned the last forecast
+        self.current_provider = None
+
+    def get_provider(self, spec):
+        """
+        Creates a provider the first time it's needed, so the ones further down the chain aren't imported unless they're used
+        """
+        if spec.name not in self.providers:
+            self.providers[spec.name] = provider_registry.create_provider(spec, **self.context)
+        return self.providers[spec.name]
+
+    def start(self, spec, answers):
+        provider = self.get_provider(spec)
+
+        def run():
+            try:
+                answers.put((spec.name, provider.get_weather(), None))
+            except Exception as error:
+                answers.put((spec.name, None, error))
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def get_weather(self):
+        answers = queue.Queue()
+        # Providers that have been started and haven't answered yet
+        running = {}
+
+        def wait_for_answer(timeout, current_name=None):
+            """
+            Returns the first forecast to arrive within `timeout`, recording each answer with its breaker.
+            Returns None early when `current_name` fails.
+            """
+            deadline = time.monotonic() + timeout
+            while running:
+                try:
+                    name, weather, error = answers.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    return None
+                if name not in running:
+                    # It was given up on already
+                    continue
+                spec = running.pop(name)
+                if weather:
+                    self.breakers[name].record_success()
+                    self.current_provider = self.providers[name]
+                    logging.info("Got weather from {}".format(spec.label))
+                    return weather
+                logging.warning("{} returned no weather: {}".format(spec.label, error))
+                self.breakers[name].record_failure()
+                if name == current_name:
+                    return None
+            return None
+
+        for current in self.specs:
+            if self.breakers[current.name].is_open():
+                logging.info("Skipping {}, it has been failing".format(current.label))
+                continue
+
+            try:
+                self.start(current, answers)
+            except Exception as error:
+                logging.warning("Unable to start {}: {}".format(current.label, error))
+                self.breakers[current.name].record_failure()
+                continue
+            running[current.name] = current
+            weather = wait_for_answer(provider_budget, current.name)
+            if weather:
+                return weather
+
+            if current.name in running:
+                logging.warning("{} is over its {:g}s budget".format(current.label, provider_budget))
+                if not hedge_providers:
+                    running.pop(current.name)
+                    self.breakers[current.name].record_failure()
+
+        # Hedged providers may still answer
+        weather = wait_for_answer(provider_budget)
+        for name in running:
+            self.breakers[name].record_failure()
+        return weather
@@ -1,8 +1,17 @@
 import logging
 import datetime
+import os
+import xml.etree.ElementTree as ET
 from datetime import timedelta
+from spans import span
 from weather_providers.base_provider import BaseWeatherProvider
 
+# How many days to forecast, including today. The calendar shows the forecast for each of its days.
+forecast_days = int(os.getenv("WEATHER_MET_EIREANN_FORECAST_DAYS", 6))
+
+# How many characters of the document are given to the XML parser at a time
+forecast_chunk_size = 64 * 1024
+
 
 class MetEireann(BaseWeatherProvider):
     '''
@@ -152,10 +161,71 @@ class MetEireann(BaseWeatherProvider):
         return description.title()
 
 
-    def hour_offset_from_now(self, h):
-        selected_hour = datetime.datetime.utcnow() + timedelta(hours=h)
-        return selected_hour.strftime("%Y-%m-%dT%H:00:00Z")
+    def get_time_string(self, value):
+        return value.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def get_point_time(self, value):
+        return datetime.datetime.fromisoformat(value[:19]).replace(tzinfo=datetime.timezone.utc)
+
+    def iter_xml_events(self, text):
+        """
+        Yields the parser's (event, element) pairs for the document, feeding it a chunk at a time,
+        so that no other copy of the whole document is made, and the rest isn't parsed once the caller stops
+        """
+        parser = ET.XMLPullParser(events=("start", "end"))
+        for offset in range(0, len(text), forecast_chunk_size):
+            parser.feed(text[offset:offset + forecast_chunk_size])
+            yield from parser.read_events()
+        parser.close()
+        yield from parser.read_events()
+
+    def index_forecast(self, text, horizon):
+        """
+        Returns {time: {"temperature": ..., "symbol": ...}} for the forecast's points up to `horizon`, in one pass.
+        Times are kept as the document's UTC strings, which sort in time order, so they're only parsed when needed.
+        The document is read as a stream: each <time> element is dropped once it's read, and reading stops
+        past the horizon, so the tree for the whole document is never built.
+        """
+        horizon = self.get_time_string(horizon)
+        index = {}
+        product = None
+        for event, element in self.iter_xml_events(text):
+            if event == "start":
+                if element.tag == "product":
+                    product = element
+                continue
+            if element.tag != "time":
+                continue
+
+            point_time = element.get("from")
+            if point_time > horizon:
+                break
+            # The temperature and the symbol for a time are in <time> elements of their own
+            values = index.setdefault(point_time, {})
+            temperature = element.find("location/temperature")
+            if temperature is not None:
+                values["temperature"] = float(temperature.get("value"))
+            symbol = element.find("location/symbol")
+            if symbol is not None:
+                values["symbol"] = int(symbol.get("number"))
+
+            if product is not None:
+                product.clear()
+        return index
+
+    def get_forecast(self, temperatures, weather_code, is_daytime):
+        temperatureMin = min(temperatures)
+        temperatureMax = max(temperatures)
+        weather = {}
+        weather["temperatureMin"] = temperatureMin if self.units == "metric" else self.c_to_f(temperatureMin)
+        weather["temperatureMax"] = temperatureMax if self.units == "metric" else self.c_to_f(temperatureMax)
+        weather["icon"] = self.get_icon_from_met_eireann_weathercode(weather_code, is_daytime)
+        weather["description"] = self.get_description_from_met_eireann_weathercode(weather_code)
+        return weather
 
+    def get_nearest_symbol(self, points, target):
+        symbols = [(abs(point_time - target), values["symbol"]) for point_time, values in points if "symbol" in values]
+        return min(symbols, key=lambda symbol: symbol[0])[1] if symbols else None
 
     # Get weather from Met Eireann's open data API:
     # https://data.gov.ie/dataset/met-eireann-weather-forecast-api
@@ -163,34 +233,38 @@ class MetEireann(BaseWeatherProvider):
         url = ("http://metwdb-openaccess.ichec.ie/metno-wdb2ts/locationforecast?lat={};long={}"
                .format(self.location_lat, self.location_long))
 
-        root = self.get_response_xml(url)
+        now = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+        first_day = datetime.date.today()
+        horizon = datetime.datetime.combine(first_day + timedelta(days=forecast_days), datetime.time.min).astimezone()
 
-        # the document contains the next day's forecast, in 24 hour-offset datapoints (as
-        # well as longer term forecasts, but we only want the next day).
-	    # scan across the next 24 hours looking for high and low temperatures
-        temps = []
-        for h in range(0, 23):
-            hour_string = self.hour_offset_from_now(h)
-            for t in root.findall("./product/time[@from='%s']/location/temperature" % (hour_string)):
-                temps.append(float(t.get("value")))
+        text = self.get_response_text(url)
+        with span("parse", provider=type(self).__name__):
+            index = self.index_forecast(text, horizon)
 
-        temps.sort()
-        temperatureMin = temps[0]
-        temperatureMax = temps[-1]
+        # The first forecast is for the next 24 hours. There's no daily summary field in the document,
+        # so its symbol is the one for an hour from now (a very near-term forecast!)
+        next_hours = [index.get(self.get_time_string(now + timedelta(hours=h)), {}) for h in range(0, 23)]
+        temperatures = [values["temperature"] for values in next_hours if "temperature" in values]
+        points = [(self.get_point_time(point_time), values) for point_time, values in index.items()]
+        weather_code = self.get_nearest_symbol(points, now + timedelta(hours=1))
+        daytime = self.is_daytime(self.location_lat, self.location_long)
+        weathers = [self.get_forecast(temperatures, weather_code, daytime)]
 
-        # unfortunately, there's no daily summary field in the document; instead,
-	    # get the symbol for just under 1 hour from now (so it's a very near-term
-        # forecast!).  TODO: maybe more than 1 hour would be better?
-        hour_string = self.hour_offset_from_now(1)
-        for sym in root.findall("./product/time[@from='%s']/location/symbol" % (hour_string)):
-            weather_code = int(sym.get("number"))
+        # The next days are whole days on the local clock, with the symbol for midday
+        points_by_day = {}
+        for point_time, values in points:
+            points_by_day.setdefault(point_time.astimezone().date(), []).append((point_time, values))
 
-        daytime = self.is_daytime(self.location_lat, self.location_long)
-        weather = {}
-        weather["temperatureMin"] = temperatureMin if self.units == "metric" else self.c_to_f(temperatureMin)
-        weather["temperatureMax"] = temperatureMax if self.units == "metric" else self.c_to_f(temperatureMax)
-        weather["icon"] = self.get_icon_from_met_eireann_weathercode(weather_code, daytime)
-        weather["description"] = self.get_description_from_met_eireann_weathercode(weather_code)
-        logging.debug(weather)
-        return weather
+        for offset in range(1, forecast_days):
+            day = first_day + timedelta(days=offset)
+            points = points_by_day.get(day, [])
+            temperatures = [values["temperature"] for _, values in points if "temperature" in values]
+            midday = datetime.datetime.combine(day, datetime.time(12)).astimezone()
+            weather_code = self.get_nearest_symbol(points, midday)
+            if not temperatures or weather_code is None:
+                # The forecast doesn't reach this far
+                break
+            weathers.append(self.get_forecast(temperatures, weather_code, True))
 
+        logging.debug(weathers)
+        return weathers